@@ -2,23 +2,592 @@
 #
 #
 
-import re
 from collections import defaultdict
+from contextlib import suppress
+from functools import partial
+from io import TextIOWrapper
+from ipaddress import ip_address
+from itertools import groupby, islice
+from json import dumps, load
 from logging import getLogger
-from os import makedirs, path
-from os.path import isdir
+from operator import itemgetter
+from os import O_RDONLY, close, environ, fsync, getpid, makedirs
+from os import open as os_open
+from os import path, remove, replace
+from os.path import getsize, isdir, isfile
+from struct import Struct
+from threading import Lock, Thread, active_count
+from time import perf_counter
 
+from octodns.provider import ProviderException
 from octodns.provider.base import BaseProvider
+from octodns.record import Record
+
+# Modules only needed by optional features, e.g. compression, workers, are
+# imported where they're used so that they don't slow down importing, and
+# constructing, the provider when they're not enabled
 
 # TODO: remove __VERSION__ with the next major version release
 __version__ = __VERSION__ = '1.1.0'
 
+# When set, the final sort & write is profiled and the stats dumped to the file
+# it names
+PROFILE_ENV_VAR = 'OCTODNS_ETCHOSTS_PROFILE'
+
+# Supported compression and the suffix added to compressed files
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'lzma': '.xz'}
+
+# Bump when the format of the incremental state file changes
+STATE_VERSION = 1
+
+# The binary index files are a header, a table of fixed size entries sorted by
+# name and then the utf-8 names the entries point into. Each entry is the
+# name's offset & length along with the packed address and its length
+INDEX_MAGIC = b'OCTOHIDX'
+INDEX_VERSION = 1
+_INDEX_HEADER = Struct('<8sII')
+_INDEX_ENTRY = Struct('<IH16sB')
+
+
+def _batched(chunks, size):
+    '''
+    Joins chunks into blocks of roughly `size` characters so that they can be
+    written with a handful of large writes rather than one per chunk.
+    '''
+    batch = []
+    length = 0
+    for chunk in chunks:
+        batch.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(batch)
+            batch = []
+            length = 0
+    if batch:
+        yield ''.join(batch)
+
+
+def _parse(lines):
+    '''
+    Parses the lines of a hosts file written by EtcHostsProvider, yielding
+    (fqdn, type, value) for each of the records it can be reconstructed from.
+    Value lines are A/AAAA unless preceded by the chain comments of an
+    ALIAS/CNAME, which are also enough to recover those that were unavailable,
+    looped or too deep. Only the first value of each record made it into the file
+    unless it was written with dual_stack.
+
+    Everything is a single pass over the lines holding on to nothing beyond
+    the current entry.
+    '''
+    # The `# <fqdn> -> <value>`s of the current entry
+    arrows = []
+    for line in lines:
+        if line == '\n':
+            # End of the entry
+            arrows = []
+        elif line[0] == '#':
+            if ' -> ' in line:
+                arrows.append(line[2:-1].split(' -> ', 1))
+            elif line == '# ** wildcard **\n':
+                # Each of the wildcard's values, or where its chain ended up,
+                # and then its fqdn
+                first = arrows[0]
+                fqdn = arrows[-1][1]
+                if first[0] == fqdn:
+                    yield fqdn, 'CNAME', first[1]
+                else:
+                    for value, _ in arrows:
+                        yield fqdn, 'AAAA' if ':' in value else 'A', value
+            elif line in (
+                '# ** unavailable **\n',
+                '# ** loop detected **\n',
+                '# ** chain too deep **\n',
+            ):
+                yield arrows[0][0], 'CNAME', arrows[0][1]
+            # Otherwise it's part of the header or notes the wildcard matched
+        else:
+            value, name = line.rstrip('\n').split('\t', 1)
+            if arrows:
+                # The start of the chain is the record itself
+                yield arrows[0][0], 'CNAME', arrows[0][1]
+            else:
+                if name[-1] != '.':
+                    # Trailing dots may have been removed
+                    name = f'{name}.'
+                yield name, 'AAAA' if ':' in value else 'A', value
+
+
+def _pack_index(entries):
+    '''
+    Packs (name, address) pairs into the binary index format.
+    '''
+    entries = sorted((name.encode('utf-8'), value) for name, value in entries)
+    table = bytearray(_INDEX_ENTRY.size * len(entries))
+    names = bytearray()
+    for i, (name, value) in enumerate(entries):
+        packed = ip_address(value).packed
+        _INDEX_ENTRY.pack_into(
+            table,
+            i * _INDEX_ENTRY.size,
+            len(names),
+            len(name),
+            packed,
+            len(packed),
+        )
+        names += name
+    header = _INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(entries))
+    return b''.join((header, table, names))
+
+
+def _grouped(parsed):
+    '''
+    Groups consecutive (fqdn, type, value)s for the same fqdn & type, the
+    values of a name are written one after another, into (fqdn, type,
+    values).
+    '''
+    for (fqdn, _type), group in groupby(parsed, key=itemgetter(0, 1)):
+        # CNAMEs are repeated for each of the values their chain ended up at
+        yield fqdn, _type, list(dict.fromkeys(value for _, _, value in group))
+
+
+class HostsIndex(object):
+    '''
+    Looks names up in the binary index written alongside a hosts file when
+    `binary_index` is enabled. The file is memory mapped and binary searched
+    so nothing is parsed up front and lookups are O(log n).
+
+    Names are as they appear in the hosts file, i.e. without trailing dots
+    when `remove_trailing_dots` is enabled.
+
+        with HostsIndex('hosts/example.com.hosts.idx') as index:
+            index.lookup('www.example.com')  # ['1.2.3.4']
+    '''
+
+    def __init__(self, filename):
+        from mmap import ACCESS_READ, mmap
+
+        with open(filename, 'rb') as fh:
+            self._mmap = mmap(fh.fileno(), 0, access=ACCESS_READ)
+        header = self._mmap[: _INDEX_HEADER.size]
+        if len(header) < _INDEX_HEADER.size or header[:8] != INDEX_MAGIC:
+            self._mmap.close()
+            raise ValueError(f'{filename} is not a hosts index')
+        _, version, count = _INDEX_HEADER.unpack(header)
+        if version != INDEX_VERSION:
+            self._mmap.close()
+            raise ValueError(
+                f'{filename} is index version {version}, not {INDEX_VERSION}'
+            )
+        self._count = count
+        self._names = _INDEX_HEADER.size + count * _INDEX_ENTRY.size
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._mmap.close()
+
+    def _entry(self, i):
+        offset, length, packed, size = _INDEX_ENTRY.unpack_from(
+            self._mmap, _INDEX_HEADER.size + i * _INDEX_ENTRY.size
+        )
+        start = self._names + offset
+        return self._mmap[start : start + length], packed[:size]
+
+    def __iter__(self):
+        for i in range(self._count):
+            name, packed = self._entry(i)
+            yield name.decode('utf-8'), str(ip_address(packed))
+
+    def lookup(self, name):
+        '''
+        Returns the addresses of name, or an empty list if it isn't in the
+        index.
+        '''
+        key = name.encode('utf-8')
+        # Find the first entry that isn't before name
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        values = []
+        for i in range(lo, self._count):
+            entry, packed = self._entry(i)
+            if entry != key:
+                break
+            values.append(str(ip_address(packed)))
+        return values
+
+
+class _Record(object):
+    '''
+    The parts of a record needed to resolve and write it out. `value` is the
+    first value of an A/AAAA or the target of an ALIAS/CNAME. `values` is only
+    used in dual-stack mode where it holds all of the A and then AAAA values
+    of the fqdn.
+    '''
+
+    __slots__ = ('fqdn', '_type', 'value', 'values')
+
+    def __init__(self, fqdn, _type, value, values=None):
+        self.fqdn = fqdn
+        self._type = _type
+        self.value = value
+        self.values = values
+
+    def __repr__(self):
+        return f'<_Record {self._type} {self.fqdn} {self.value}>'
+
+
+class _WildcardNode(object):
+    __slots__ = ('children', 'entries')
+
+    def __init__(self):
+        self.children = {}
+        self.entries = []
+
+
+class _WildcardIndex(object):
+    '''
+    Finds the most specific wildcard record matching a fqdn.
+
+    Standard wildcards, `*.<labels>`, are stored in a trie keyed by their
+    labels in reverse order so a lookup walks at most as many nodes as the
+    fqdn has labels. Anything else with a `*` in it is treated as a regex,
+    matching the original behavior exactly. When the only `*` is the leading
+    one that regex, `^.*<rest>$`, is a suffix match so those are looked up in
+    a table keyed by suffix. What's left is compiled, by `sort`, into a single
+    alternation in priority order so that one match finds the most specific
+    of them.
+    '''
+
+    def __init__(self):
+        self._root = _WildcardNode()
+        self._suffixes = {}
+        # Lengths of the suffixes, longest first
+        self._lengths = []
+        self._irregular = []
+        self._matcher = None
+        self._seq = 0
+        # Entry lists that have been added to since they were last sorted
+        self._unsorted = {}
+
+    def add(self, record):
+        fqdn = record.fqdn
+        # We want longest match first, preferring A over AAAA so we'll prepend
+        # some bits to sort by here, the `-` is to reverse length and still
+        # allow type/the sort to be reverse=False, `seq` keeps things stable
+        entry = (1024 - len(fqdn), record._type, self._seq, record)
+        self._seq += 1
+
+        if '*' in fqdn[1:]:
+            regex = fqdn.replace('.', '\\.')
+            entries = self._irregular
+            entries.append((entry, f'.{regex}'))
+        elif fqdn[1] == '.':
+            node = self._root
+            for label in reversed(fqdn[2:].split('.')):
+                try:
+                    node = node.children[label]
+                except KeyError:
+                    child = _WildcardNode()
+                    node.children[label] = child
+                    node = child
+            entries = node.entries
+            entries.append(entry)
+        else:
+            suffix = fqdn[1:]
+            entries = self._suffixes.setdefault(suffix, [])
+            entries.append(entry)
+            if len(suffix) not in self._lengths:
+                self._lengths.append(len(suffix))
+                self._lengths.sort(reverse=True)
+        self._unsorted[id(entries)] = entries
+
+    def sort(self):
+        # Sort A before AAAA, as we prefer A when available, and irregulars
+        # longest first so that we match most specific. The entries are unique
+        # so the regexes are never compared. Only what's been added to since
+        # the last sort needs it so this is cheap to call repeatedly
+        irregular = self._irregular
+        if id(irregular) in self._unsorted:
+            import re
+
+            irregular.sort()
+            # The first alternative that matches wins and they're in order
+            alternation = '|'.join(f'({regex})' for _, regex in irregular)
+            self._matcher = re.compile(f'^(?:{alternation})$')
+        for entries in self._unsorted.values():
+            entries.sort()
+        self._unsorted.clear()
+
+    def match(self, fqdn):
+        labels = fqdn.split('.')
+        best = None
+        node = self._root
+        # There must be at least one label left over to match the `*`
+        for i in range(len(labels) - 1, 0, -1):
+            node = node.children.get(labels[i])
+            if node is None:
+                break
+            if node.entries:
+                best = node.entries[0]
+
+        # Longer suffixes are more specific so the first one found is the best
+        # of them
+        n = len(fqdn)
+        for length in self._lengths:
+            if length <= n:
+                entries = self._suffixes.get(fqdn[n - length :])
+                if entries:
+                    if best is None or entries[0] < best:
+                        best = entries[0]
+                    break
+
+        if self._matcher is not None:
+            match = self._matcher.match(fqdn)
+            if match:
+                entry = self._irregular[match.lastindex - 1][0]
+                if best is None or entry < best:
+                    best = entry
+
+        return best[3] if best else None
+
+
+class _Chain(object):
+    '''
+    The resolved path from a record through any ALIAS/CNAME hops.
+
+    Chains are linked through `next` so that records sharing a suffix share
+    the cached links rather than each holding a copy of the path. `depth` is
+    the number of ALIAS/CNAME hops in the path, `node` the last record reached
+    and `looped` whether the path ended by running into itself.
+    '''
+
+    __slots__ = ('record', 'next', 'depth', 'node', 'looped')
+
+    def __init__(self, record, next, depth, node, looped):
+        self.record = record
+        self.next = next
+        self.depth = depth
+        self.node = node
+        self.looped = looped
+
+    def __iter__(self):
+        link = self
+        for _ in range(self.depth):
+            yield link.record
+            link = link.next
+
+
+class _Pending(Exception):
+    '''
+    Raised when resolving needs to look up a fqdn in a zone that hasn't been
+    seen yet.
+    '''
+
+    def __init__(self, zone):
+        super().__init__(zone)
+        self.zone = zone
+
 
-def _wildcard_match(fqdn, wildcards):
-    for _, _, regex, record in wildcards:
-        if regex.match(fqdn):
+class _Resolver(object):
+    '''
+    Follows ALIAS/CNAME records to the records they point at.
+
+    Both the record each target fqdn resolves to and the chain hanging off of
+    each ALIAS/CNAME record are cached so that every hop is only walked once
+    no matter how many records, or zones, share it.
+
+    `pending`, if provided, is the set of names of zones whose records haven't
+    been indexed yet. Looking up anything in one of them raises `_Pending`
+    rather than caching an answer that may later change.
+
+    The counters are informational, when shared between threads they're best
+    effort.
+    '''
+
+    def __init__(self, records, wildcards, pending=None):
+        self.records = records
+        self.wildcards = wildcards
+        self.pending = pending
+
+        self._targets = {}
+        self._chains = {}
+
+        self.target_hits = 0
+        self.target_misses = 0
+        self.wildcard_lookups = 0
+        self.chain_hits = 0
+
+    @property
+    def counts(self):
+        return {
+            'target_hits': self.target_hits,
+            'target_misses': self.target_misses,
+            'wildcard_lookups': self.wildcard_lookups,
+            'chain_hits': self.chain_hits,
+            'chains': len(self._chains),
+        }
+
+    def pending_zone(self, fqdn):
+        '''
+        Returns the name of the pending zone fqdn falls within, if any.
+        '''
+        pending = self.pending
+        i = 0
+        while i < len(fqdn):
+            suffix = fqdn[i:]
+            if suffix in pending:
+                return suffix
+            i = fqdn.find('.', i) + 1
+            if i == 0:
+                break
+        return None
+
+    def lookup(self, fqdn):
+        try:
+            record = self._targets[fqdn]
+            self.target_hits += 1
             return record
-    return None
+        except KeyError:
+            pass
+        if self.pending:
+            # Anything in, or matched by a wildcard in, a zone that we haven't
+            # seen yet would have to be under it
+            zone = self.pending_zone(fqdn)
+            if zone is not None:
+                raise _Pending(zone)
+        self.target_misses += 1
+        record = self.records.get(fqdn)
+        if record is None:
+            # No exact match, look for wildcards
+            self.wildcard_lookups += 1
+            record = self.wildcards.match(fqdn)
+        self._targets[fqdn] = record
+        return record
+
+    def resolve(self, record):
+        if record._type not in ('ALIAS', 'CNAME'):
+            return _Chain(record, None, 0, record, False)
+
+        chains = self._chains
+        try:
+            chain = chains[id(record)]
+            self.chain_hits += 1
+            return chain
+        except KeyError:
+            pass
+
+        # Walk forward until we reach something we've already resolved, a
+        # value record, a dead end, or a record already on our path
+        path = []
+        on_path = {}
+        current = record
+        while True:
+            key = id(current)
+            try:
+                tail = chains[key]
+                self.chain_hits += 1
+                break
+            except KeyError:
+                pass
+            if current._type not in ('ALIAS', 'CNAME'):
+                tail = _Chain(current, None, 0, current, False)
+                break
+            if key in on_path:
+                # Loop, everything from where we first saw current onwards is
+                # part of it and each of them will walk all the way around
+                cycle = path[on_path[key] :]
+                del path[on_path[key] :]
+                depth = len(cycle)
+                links = [
+                    _Chain(n, None, depth, cycle[i - 1], True)
+                    for i, n in enumerate(cycle)
+                ]
+                for i, link in enumerate(links):
+                    link.next = links[(i + 1) % depth]
+                # Only share them once they're all linked up
+                for link in links:
+                    chains[id(link.record)] = link
+                tail = links[0]
+                break
+            on_path[key] = len(path)
+            path.append(current)
+            nxt = self.lookup(current.value)
+            if nxt is None:
+                # Dead end, we didn't make it all the way to an A/AAAA
+                path.pop()
+                tail = _Chain(current, None, 1, current, False)
+                chains[key] = tail
+                break
+            current = nxt
+
+        for node in reversed(path):
+            tail = _Chain(node, tail, tail.depth + 1, tail.node, tail.looped)
+            chains[id(node)] = tail
+
+        return chains[id(record)]
+
+
+# What the shard processes render from, set before they're forked so that they
+# inherit it rather than having it pickled over to them
+_shared = None
+
+
+def _render_shard(shard):
+    '''
+    Renders records[start:stop] of the named zone in a shard process.
+    '''
+    provider, resolver, zones = _shared
+    name, start, stop = shard
+    counts = defaultdict(int)
+    entries = [] if provider.binary_index else None
+    report = [] if provider.diagnostics else None
+    text = ''.join(
+        provider._render_records(
+            zones[name][start:stop],
+            resolver,
+            defaultdict(float),
+            counts,
+            entries,
+            report,
+        )
+    )
+    return text, counts, entries, report
+
+
+class _Stats(object):
+    '''
+    Timings, in seconds, and counts collected while applying and writing.
+    '''
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._lock = Lock()
+
+    def add(self, timings=None, counts=None):
+        with self._lock:
+            for k, v in (timings or {}).items():
+                self.timings[k] += v
+            for k, v in (counts or {}).items():
+                self.counts[k] += v
+
+    def __repr__(self):
+        timings = ', '.join(f'{k}={v:.6f}s' for k, v in self.timings.items())
+        counts = ', '.join(f'{k}={v}' for k, v in self.counts.items())
+        return f'timings: {timings}; counts: {counts}'
 
 
 class EtcHostsProvider(BaseProvider):
@@ -27,25 +596,145 @@ class EtcHostsProvider(BaseProvider):
     SUPPORTS = set(('A', 'AAAA', 'ALIAS', 'CNAME'))
 
     def __init__(
-        self, id, directory, remove_trailing_dots=True, *args, **kwargs
+        self,
+        id,
+        directory,
+        remove_trailing_dots=True,
+        buffer_size=1024 * 1024,
+        fsync=False,
+        workers=1,
+        combined_file=None,
+        combined_names_per_line=1,
+        incremental=False,
+        write_early=False,
+        source_ttl=3600,
+        binary_index=False,
+        compression=None,
+        compression_level=None,
+        verbosity='full',
+        diagnostics=False,
+        dual_stack=False,
+        queue_depth=0,
+        lint_report=None,
+        lint_max_depth=None,
+        strict=False,
+        max_chain_depth=None,
+        processes=1,
+        shard_size=100000,
+        *args,
+        **kwargs,
     ):
         self.log = getLogger(f'EtcHostsProvider[{id}]')
-        self.log.debug('__init__: id=%s, directory=%s', id, directory)
+        self.log.debug(
+            '__init__: id=%s, directory=%s, buffer_size=%d, fsync=%s, '
+            'workers=%d, combined_file=%s, combined_names_per_line=%d, '
+            'incremental=%s, write_early=%s, source_ttl=%d, '
+            'binary_index=%s, compression=%s, compression_level=%s, '
+            'verbosity=%s, diagnostics=%s, dual_stack=%s, queue_depth=%d, '
+            'lint_report=%s, lint_max_depth=%s, strict=%s, '
+            'max_chain_depth=%s, processes=%d, shard_size=%d',
+            id,
+            directory,
+            buffer_size,
+            fsync,
+            workers,
+            combined_file,
+            combined_names_per_line,
+            incremental,
+            write_early,
+            source_ttl,
+            binary_index,
+            compression,
+            compression_level,
+            verbosity,
+            diagnostics,
+            dual_stack,
+            queue_depth,
+            lint_report,
+            lint_max_depth,
+            strict,
+            max_chain_depth,
+            processes,
+            shard_size,
+        )
+        if compression is not None and compression not in COMPRESSION_SUFFIXES:
+            raise ProviderException(
+                f'Unsupported compression {compression}, must be one of '
+                f'{", ".join(sorted(COMPRESSION_SUFFIXES))}'
+            )
+        if compression_level is not None and compression_level not in range(10):
+            raise ProviderException(
+                f'Unsupported compression_level {compression_level}, must be '
+                '0-9'
+            )
+        if verbosity not in ('full', 'minimal'):
+            raise ProviderException(
+                f'Unsupported verbosity {verbosity}, must be full or minimal'
+            )
+        if diagnostics and verbosity != 'minimal':
+            raise ProviderException(
+                'diagnostics requires minimal verbosity, full output already '
+                'includes everything'
+            )
+        if max_chain_depth is not None and max_chain_depth < 0:
+            raise ProviderException(
+                f'Unsupported max_chain_depth {max_chain_depth}, must be 0 or '
+                'more'
+            )
+        if processes < 1:
+            raise ProviderException(
+                f'Unsupported processes {processes}, must be 1 or more'
+            )
+        if shard_size < 1:
+            raise ProviderException(
+                f'Unsupported shard_size {shard_size}, must be 1 or more'
+            )
+        if processes > 1:
+            from multiprocessing import get_all_start_methods
+
+            if 'fork' not in get_all_start_methods():
+                raise ProviderException(
+                    'processes requires the fork start method, which is not '
+                    'available on this platform'
+                )
         super().__init__(id, *args, **kwargs)
         self.directory = directory
         self.remove_trailing_dots = remove_trailing_dots
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.workers = workers
+        self.combined_file = combined_file
+        self.combined_names_per_line = combined_names_per_line
+        self.incremental = incremental
+        self.write_early = write_early
+        self.source_ttl = source_ttl
+        self.binary_index = binary_index
+        self.compression = compression
+        self.compression_level = compression_level
+        self.verbosity = verbosity
+        self.diagnostics = diagnostics
+        self.dual_stack = dual_stack
+        self.queue_depth = queue_depth
+        self.lint_report = lint_report
+        self.lint_max_depth = lint_max_depth
+        self.strict = strict
+        self.max_chain_depth = max_chain_depth
+        self.processes = processes
+        self.shard_size = shard_size
+
+        self.stats = _Stats()
 
         self._expected_zones = set()
-        self._records = defaultdict(list)
-        self._wildcards = []
+        self._records = {}
+        self._wildcards = _WildcardIndex()
         self._zones = []
-
-        self._a_values = {}
-        self._aaaa_values = {}
-        self._cname_values = {}
-        self._a_wildcards = []
-        self._aaaa_wildcards = []
-        self._cname_wildcards = []
+        # zone name -> fqdn -> signature of its records, only when incremental
+        self._signatures = {}
+        # pending zone name -> zones waiting on it, only when writing early
+        self._blocked = defaultdict(list)
+        self._resolver = None
+        # The shard processes, only while writing zones that need them
+        self._pool = None
 
     def populate(self, zone, target=False, lenient=False):
         self.log.debug(
@@ -55,116 +744,921 @@ class EtcHostsProvider(BaseProvider):
             lenient,
         )
 
-        self._expected_zones.add(zone.name)
+        if target:
+            # We don't read back what we've written when acting as a target,
+            # everything is always rewritten
+            self._expected_zones.add(zone.name)
+            return False
 
-        # We never act as a source, at least for now, if/when we do we still
-        # need to noop `if target`
-        return False
+        if self.verbosity == 'minimal':
+            # Without the chain comments & markers there's no telling
+            # CNAMEs/ALIASes from A/AAAAs and everything else is missing
+            self.log.warning(
+                'populate: minimal verbosity files cannot be used as a '
+                'source, not populating %s',
+                zone.name,
+            )
+            return False
+
+        filename = f'{self._filename(zone.name)}{self._suffix}'
+        try:
+            if self.compression == 'gzip':
+                from gzip import open as gzip_open
+
+                fh = gzip_open(filename, 'rt')
+            elif self.compression == 'lzma':
+                from lzma import open as lzma_open
+
+                fh = lzma_open(filename, 'rt')
+            else:
+                fh = open(filename, buffering=self.buffer_size)
+        except FileNotFoundError:
+            return False
+
+        start = perf_counter()
+        before = len(zone.records)
+        with fh:
+            for fqdn, _type, values in _grouped(_parse(fh)):
+                name = zone.hostname_from_fqdn(fqdn)
+                data = {'ttl': self.source_ttl, 'type': _type}
+                if _type == 'CNAME':
+                    data['value'] = values[0]
+                    if not name:
+                        # CNAMEs can't live at the root
+                        data['type'] = 'ALIAS'
+                else:
+                    data['values'] = values
+                record = Record.new(
+                    zone, name, data, source=self, lenient=lenient
+                )
+                zone.add_record(record, lenient=lenient)
+        found = len(zone.records) - before
+
+        self.stats.add(
+            timings={'populate': perf_counter() - start},
+            counts={'populated_records': found},
+        )
+        self.log.info('populate:   found %s records', found)
+
+        return True
+
+    def _resolved(self, records, resolver, timings):
+        for record in records:
+            # Follow any symlinks
+            start = perf_counter()
+            chain = resolver.resolve(record)
+            timings['resolve'] += perf_counter() - start
+            yield record, chain
+
+    def _sanitize(self, fqdn):
+        # Strip trailing dots if specified
+        if self.remove_trailing_dots and fqdn[-1] == '.':
+            return fqdn[0:-1]
+        return fqdn
+
+    def _render(
+        self,
+        name,
+        records,
+        resolver,
+        timings,
+        counts,
+        entries=None,
+        report=None,
+    ):
+        header = (
+            '##################################################\n'
+            f'# octoDNS {self.id} {name}\n'
+            '##################################################\n\n'
+        )
+        # Minimal output is only the value lines, everything else goes to the
+        # report, if there is one
+        minimal = self.verbosity == 'minimal'
+        if not minimal:
+            yield header
+        elif report is not None:
+            report.append(header)
+
+        if self._pool is not None and len(records) > self.shard_size:
+            yield from self._render_sharded(
+                name, records, counts, entries, report
+            )
+            return
+
+        yield from self._render_records(
+            records, resolver, timings, counts, entries, report
+        )
+
+    def _render_sharded(self, name, records, counts, entries, report):
+        '''
+        Renders records in shard_size slices across the shard processes,
+        handing back what they rendered in order. Their timings stay behind,
+        the time spent waiting on them shows up as rendering.
+        '''
+        size = self.shard_size
+        shards = [(name, i, i + size) for i in range(0, len(records), size)]
+        self.log.debug('_render_sharded: name=%s, shards=%d', name, len(shards))
+        for text, shard_counts, shard_entries, shard_report in self._pool.imap(
+            _render_shard, shards
+        ):
+            for k, v in shard_counts.items():
+                counts[k] += v
+            if entries is not None:
+                entries.extend(shard_entries)
+            if report is not None:
+                report.extend(shard_report)
+            yield text
+
+    def _render_records(
+        self, records, resolver, timings, counts, entries, report
+    ):
+        minimal = self.verbosity == 'minimal'
+        max_depth = self.max_chain_depth
+        for record, chain in self._resolved(records, resolver, timings):
+            fqdn = record.fqdn
+
+            # Walk the path, only as far as max_chain_depth so that long
+            # chains don't make the output, and time, quadratic
+            too_deep = max_depth is not None and chain.depth > max_depth
+            links = islice(chain, max_depth) if too_deep else chain
+            lines = [f'# {link.fqdn} -> {link.value}\n' for link in links]
+            node = chain.node
+
+            sanitized_fqdn = self._sanitize(fqdn)
+            value_line = None
+
+            if too_deep:
+                # We gave up before reaching the end
+                lines.append('# ** chain too deep **\n')
+                counts['too_deep'] += 1
+            elif chain.looped:
+                # We detected a loop, indicate it
+                lines.append('# ** loop detected **\n')
+                counts['loops'] += 1
+            elif node._type in ('ALIAS', 'CNAME'):
+                # We didn't make it all the way to an A/AAAA
+                lines.append('# ** unavailable **\n')
+                counts['unavailable'] += 1
+            elif fqdn[0] == '*':
+                # the record is a wildcard, just add a comment with info about
+                # it
+                for value in node.values or (node.value,):
+                    lines.append(f'# {value} -> {fqdn}\n')
+                lines.append('# ** wildcard **\n')
+                counts['wildcards'] += 1
+            else:
+                if node.fqdn[0] == '*':
+                    # The last node is a wildcard, note that in a commend and
+                    # print the value
+                    lines.append(f'# {node.fqdn}\n')
+                # The last node is a value node, just print it
+                values = node.values
+                if values is None:
+                    value_line = f'{node.value}\t{sanitized_fqdn}\n'
+                    counts['values'] += 1
+                    if entries is not None:
+                        entries.append((sanitized_fqdn, node.value))
+                else:
+                    # Every A & AAAA value
+                    value_line = ''.join(
+                        f'{value}\t{sanitized_fqdn}\n' for value in values
+                    )
+                    counts['values'] += len(values)
+                    if entries is not None:
+                        entries.extend(
+                            (sanitized_fqdn, value) for value in values
+                        )
+                lines.append(value_line)
+
+            lines.append('\n')
+            if not minimal:
+                yield ''.join(lines)
+                continue
+
+            if value_line is not None:
+                yield value_line
+            if report is not None and len(lines) > 2:
+                # There's more to it than just the value
+                report.append(''.join(lines))
+
+    def _render_combined(
+        self, resolver, timings, counts, entries=None, report=None
+    ):
+        # There's no report, what doesn't make it into the file is only
+        # counted
+        if self.verbosity != 'minimal':
+            yield (
+                '##################################################\n'
+                f'# octoDNS {self.id}\n'
+                '##################################################\n\n'
+            )
+
+        max_depth = self.max_chain_depth
+        per_line = self.combined_names_per_line
+        seen = set()
+        grouped = {}
+        for _, records in self._zones:
+            for record, chain in self._resolved(records, resolver, timings):
+                node = chain.node
+                if max_depth is not None and chain.depth > max_depth:
+                    counts['too_deep'] += 1
+                    continue
+                elif chain.looped:
+                    counts['loops'] += 1
+                    continue
+                elif node._type in ('ALIAS', 'CNAME'):
+                    counts['unavailable'] += 1
+                    continue
+                elif record.fqdn[0] == '*':
+                    # Wildcards can't go in a hosts file
+                    counts['wildcards'] += 1
+                    continue
+
+                name = self._sanitize(record.fqdn)
+                for value in node.values or (node.value,):
+                    if (value, name) in seen:
+                        counts['duplicates'] += 1
+                        continue
+                    seen.add((value, name))
+                    counts['values'] += 1
+                    if entries is not None:
+                        entries.append((name, value))
+
+                    if per_line == 1:
+                        yield f'{value}\t{name}\n'
+                        continue
+
+                    names = grouped.setdefault(value, [])
+                    names.append(name)
+                    if len(names) == per_line:
+                        del grouped[value]
+                        yield f'{value}\t{" ".join(names)}\n'
+
+        for value, names in grouped.items():
+            yield f'{value}\t{" ".join(names)}\n'
 
     def _write(self):
         if not isdir(self.directory):
             makedirs(self.directory)
 
-        # Resolve all the records
-        for zone in self._zones:
-            name = zone.name
-            filepath = path.join(self.directory, name)
-            filename = f'{filepath}hosts'
-            self.log.info('_apply: filename=%s', filename)
-            with open(filename, 'w') as fh:
-                fh.write('##################################################\n')
-                fh.write(f'# octoDNS {self.id} {name}\n')
-                fh.write(
-                    '##################################################\n\n'
-                )
+        resolver = _Resolver(self._records, self._wildcards)
 
-                seen = set()
-                for record in sorted(zone.records):
-                    # Ignore AAAAs when we've seen an A with the same fqdn
-                    fqdn = record.fqdn
-                    if fqdn in seen:
-                        continue
-                    seen.add(fqdn)
-
-                    # Follow any symlinks
-                    current = record
-                    stack = [current]
-                    looped = False
-                    while current and current._type in ('ALIAS', 'CNAME'):
-                        value = current.value
-                        try:
-                            current = self._records[value][0]
-                        except (IndexError, KeyError):
-                            # No exact match, look for wildcards
-                            current = _wildcard_match(value, self._wildcards)
-
-                        if current:
-                            if current in stack:
-                                # Loop, break...
-                                looped = True
-                                break
-                            stack.append(current)
-
-                    # Walk the stack/path
-                    for node in stack:
-                        if node._type in ('ALIAS', 'CNAME'):
-                            fh.write(f'# {node.fqdn} -> {node.value}\n')
-                    # `node` will be the last element in the stack
-
-                    # Strip trailing dots if specified
-                    sanitized_fqdn = fqdn
-                    if self.remove_trailing_dots and sanitized_fqdn[-1] == '.':
-                        sanitized_fqdn = fqdn[0:-1]
-
-                    if looped:
-                        # We detected a loop, indicate it
-                        fh.write('# ** loop detected **\n')
-                    elif node._type in ('ALIAS', 'CNAME'):
-                        # We didn't make it all the way to an A/AAAA
-                        fh.write('# ** unavailable **\n')
-                    elif fqdn[0] == '*':
-                        # the record is a wildcard, just add a comment with
-                        # info about it
-                        fh.write(f'# {node.values[0]} -> {fqdn}\n')
-                        fh.write('# ** wildcard **\n')
-                    elif node.fqdn[0] == '*':
-                        # The last node is a wildcard, note that in a commend
-                        # and print the value
-                        fh.write(f'# {node.fqdn}\n')
-                        fh.write(f'{node.values[0]}\t{sanitized_fqdn}\n')
-                    else:
-                        # The last node is a value node, just print it
-                        fh.write(f'{node.values[0]}\t{sanitized_fqdn}\n')
-
-                    fh.write('\n')
+        if self.lint_report or self.strict:
+            self._lint(resolver)
+
+        zones = self._zones
+        incremental = self.incremental and not self.combined_file
+        if incremental:
+            state = self._load_state()
+            dirty = self._dirty(state)
+            zones = [zone for zone in zones if zone[0] in dirty]
+            self.log.info(
+                '_write: incremental, rendering %d of %d zones',
+                len(zones),
+                len(self._zones),
+            )
+            self.stats.add(
+                counts={'zones_skipped': len(self._zones) - len(zones)}
+            )
+
+        if self.combined_file:
+            # Everything goes into a single file
+            filename = path.join(self.directory, self.combined_file)
+            render = partial(self._render_combined, resolver)
+            results = [self._write_rendered(filename, render)]
+        else:
+            results = self._write_zones(zones, resolver)
+
+        if incremental:
+            self._save_state(state, zones, resolver)
+
+        written = sum(results)
+        unchanged = len(results) - written
+        self.stats.add(
+            counts={
+                'files_written': written,
+                'files_unchanged': unchanged,
+                **resolver.counts,
+            }
+        )
+        self.log.info('_write: written=%d, unchanged=%d', written, unchanged)
+        self.log.debug('_write: stats %s', self.stats)
 
         return
 
-    def _apply(self, plan):
-        # Store the zone with its records
-        desired = plan.desired
-        name = desired.name
+    def _lint(self, resolver):
+        '''
+        Checks the chains of every ALIAS/CNAME record for loops, targets that
+        don't resolve and, with lint_max_depth, chains that are too long.
+
+        The chains are what the resolver will share with the writing that
+        follows so the pass over the whole graph is linear and mostly work
+        that had to happen anyway.
+        '''
+        start = perf_counter()
+
+        max_depth = self.lint_max_depth
+        loops = {}
+        # id of each looped link we've been through -> the fqdn its loop is
+        # reported under
+        cycles = {}
+        dangling = {}
+        too_deep = []
+        for _, records in self._zones:
+            for record in records:
+                if record._type not in ('ALIAS', 'CNAME'):
+                    continue
+                chain = resolver.resolve(record)
+                node = chain.node
+                if chain.looped:
+                    # Follow the links, which are shared with every other
+                    # record that reaches the same loop, until we're in the
+                    # loop, whose links all have its length as their depth,
+                    # or somewhere we've already been
+                    links = []
+                    link = chain
+                    while (
+                        id(link) not in cycles and link.next.depth != link.depth
+                    ):
+                        links.append(link)
+                        link = link.next
+                    key = cycles.get(id(link))
+                    if key is None:
+                        # A loop we haven't seen before, start it from the
+                        # lowest fqdn so that it has one form
+                        cycle = []
+                        for _ in range(link.depth):
+                            cycle.append(link)
+                            link = link.next
+                        i = cycle.index(min(cycle, key=lambda c: c.record.fqdn))
+                        cycle = cycle[i:] + cycle[:i]
+                        key = cycle[0].record.fqdn
+                        loops[key] = [c.record.fqdn for c in cycle]
+                        links.extend(cycle)
+                    for link in links:
+                        cycles[id(link)] = key
+                elif node._type in ('ALIAS', 'CNAME'):
+                    dangling[node.fqdn] = node.value
+                if max_depth is not None and chain.depth > max_depth:
+                    too_deep.append({'fqdn': record.fqdn, 'depth': chain.depth})
+
+        report = {
+            'loops': [loops[k] for k in sorted(loops)],
+            'dangling': [
+                {'fqdn': fqdn, 'target': dangling[fqdn]}
+                for fqdn in sorted(dangling)
+            ],
+            'too_deep': too_deep,
+        }
+        counts = {
+            'lint_loops': len(loops),
+            'lint_dangling': len(dangling),
+            'lint_too_deep': len(too_deep),
+        }
+        self.stats.add(timings={'lint': perf_counter() - start}, counts=counts)
+        self.log.info(
+            '_lint: loops=%d, dangling=%d, too_deep=%d', *counts.values()
+        )
+
+        if self.lint_report:
+            filename = path.join(self.directory, self.lint_report)
+            self._write_file(filename, [dumps(report, indent=2)])
+
+        if self.strict and any(counts.values()):
+            raise ProviderException(
+                f'Lint failed with {len(loops)} loops, {len(dangling)} '
+                f'dangling targets and {len(too_deep)} chains that are too '
+                'deep'
+            )
+
+        return report
+
+    def _write_zones(self, zones, resolver):
+        if self.processes > 1 and any(
+            len(records) > self.shard_size for _, records in zones
+        ):
+            if active_count() > 1:
+                # Forking a process with other threads running, e.g. octoDNS's
+                # own workers, risks deadlocking on locks they hold
+                self.log.warning(
+                    '_write_zones: other threads are running, not rendering '
+                    'in shard processes'
+                )
+                return self._write_zones_threaded(zones, resolver)
+
+            global _shared
+            from multiprocessing import get_context
+
+            # The shard processes inherit the indexes & resolver when they're
+            # forked, which happens here, before we start any threads of our
+            # own
+            _shared = (self, resolver, dict(zones))
+            try:
+                with get_context('fork').Pool(self.processes) as pool:
+                    self._pool = pool
+                    return self._write_zones_threaded(zones, resolver)
+            finally:
+                self._pool = None
+                _shared = None
+        return self._write_zones_threaded(zones, resolver)
+
+    def _write_zones_threaded(self, zones, resolver):
+        if self.workers > 1 and len(zones) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            # The indexes & resolver are shared by all of the workers
+            write_zone = partial(self._write_zone, resolver=resolver)
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                return list(executor.map(write_zone, zones))
+        return [self._write_zone(zone, resolver) for zone in zones]
+
+    @property
+    def _writing_early(self):
+        # Combined and incremental output, linting and sharding, which would
+        # otherwise fork a pool for every zone, all need all of the zones
+        return (
+            self.write_early
+            and not self.combined_file
+            and not self.incremental
+            and not self.lint_report
+            and not self.strict
+            and self.processes == 1
+        )
+
+    def _write_ready(self, zone):
+        '''
+        Writes out zone, and anything that was waiting on it, if everything
+        their chains look up is in zones that have already been applied.
+        Zones that can't be written yet are held on to until the zone they're
+        waiting on is applied.
+        '''
+        resolver = self._resolver
+        if resolver is None:
+            if not isdir(self.directory):
+                makedirs(self.directory)
+            resolver = self._resolver = _Resolver(
+                self._records, self._wildcards, self._expected_zones
+            )
+
+        self._sort()
+
+        ready = []
+        deferred = 0
+        for candidate in [zone] + self._blocked.pop(zone[0], []):
+            try:
+                for record in candidate[1]:
+                    resolver.resolve(record)
+            except _Pending as e:
+                self._blocked[e.zone].append(candidate)
+                deferred += 1
+                continue
+            ready.append(candidate)
+
+        results = self._write_zones(ready, resolver)
+
+        written = sum(results)
+        unchanged = len(results) - written
+        self.stats.add(
+            counts={
+                'files_written': written,
+                'files_unchanged': unchanged,
+                'zones_deferred': deferred,
+            }
+        )
+        self.log.info(
+            '_write_ready: zone=%s, written=%d, unchanged=%d, deferred=%d',
+            zone[0],
+            written,
+            unchanged,
+            deferred,
+        )
+
+    def _filename(self, name):
+        filepath = path.join(self.directory, name)
+        return f'{filepath}hosts'
+
+    @property
+    def _suffix(self):
+        return COMPRESSION_SUFFIXES.get(self.compression, '')
+
+    @property
+    def _state_filename(self):
+        return path.join(self.directory, '.etchosts-state.json')
+
+    def _state_options(self):
+        # Anything that changes the contents of the zone files, if any of them
+        # change everything has to be rewritten
+        return {
+            'id': self.id,
+            'remove_trailing_dots': self.remove_trailing_dots,
+            'binary_index': self.binary_index,
+            'compression': self.compression,
+            'compression_level': self.compression_level,
+            'verbosity': self.verbosity,
+            'diagnostics': self.diagnostics,
+            'dual_stack': self.dual_stack,
+            'max_chain_depth': self.max_chain_depth,
+        }
+
+    def _load_state(self):
+        try:
+            with open(self._state_filename) as fh:
+                state = load(fh)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            self.log.warning('_load_state: invalid state file, ignoring it')
+            return None
+        if (
+            state.get('version') != STATE_VERSION
+            or state.get('options') != self._state_options()
+        ):
+            self.log.info('_load_state: state out of date, ignoring it')
+            return None
+        return state
+
+    def _dirty(self, state):
+        '''
+        Works out which zones' output may have changed since the state was
+        saved, their own records changed, something they depend on changed,
+        or their file is missing.
+        '''
+        signatures = self._signatures
+        if state is None:
+            return set(signatures)
+        previous = state['zones']
+
+        # Everything with records that were added, removed, or changed
+        changed = set()
+        dirty = set()
+        for name in signatures.keys() | previous.keys():
+            if name not in previous:
+                # New zone
+                dirty.add(name)
+            current = signatures.get(name, {})
+            before = previous.get(name, {}).get('records', {})
+            diff = {
+                fqdn
+                for fqdn in current.keys() | before.keys()
+                if current.get(fqdn) != before.get(fqdn)
+            }
+            if diff:
+                changed.update(diff)
+                dirty.add(name)
+
+        # Changes to wildcards impact anything that they match or matched
+        changed_wildcards = [fqdn for fqdn in changed if fqdn[0] == '*']
+        wildcards = _WildcardIndex()
+        for fqdn in changed_wildcards:
+            wildcards.add(_Record(fqdn, 'A', None))
+        wildcards.sort()
+
+        for name in signatures:
+            if name in dirty:
+                continue
+            dependencies = previous[name]['dependencies']
+            if not changed.isdisjoint(dependencies) or (
+                changed_wildcards
+                and any(wildcards.match(fqdn) for fqdn in dependencies)
+            ):
+                dirty.add(name)
+            elif not isfile(f'{self._filename(name)}{self._suffix}'):
+                dirty.add(name)
+
+        return dirty
 
+    def _save_state(self, state, rendered, resolver):
+        zones = state['zones'] if state else {}
+        for name, records in rendered:
+            # Everything a zone's chains looked up, where they ended up depends
+            # on what's at, or matches, those names. Chains share their links
+            # so once we reach one we've seen the rest of the chain has been
+            # covered too, keeping this linear no matter how long they are
+            dependencies = set()
+            visited = set()
+            for record in records:
+                link = resolver.resolve(record)
+                for _ in range(link.depth):
+                    if id(link) in visited:
+                        break
+                    visited.add(id(link))
+                    dependencies.add(link.record.value)
+                    link = link.next
+            zones[name] = {'dependencies': sorted(dependencies)}
+        # Anything that's gone away is dropped
+        zones = {
+            name: {**zones[name], 'records': signatures}
+            for name, signatures in self._signatures.items()
+        }
+
+        data = dumps(
+            {
+                'version': STATE_VERSION,
+                'options': self._state_options(),
+                'zones': zones,
+            }
+        )
+        self._write_file(self._state_filename, [data])
+
+    def _write_zone(self, zone, resolver):
+        name, records = zone
+        filename = self._filename(name)
+        render = partial(self._render, name, records, resolver)
+        return self._write_rendered(filename, render)
+
+    def _write_rendered(self, filename, render):
+        self.log.info('_apply: filename=%s', filename)
+
+        timings = defaultdict(float)
+        counts = defaultdict(int)
+        start = perf_counter()
+        entries = [] if self.binary_index else None
+        report = [] if self.diagnostics else None
+        chunks = render(
+            timings=timings, counts=counts, entries=entries, report=report
+        )
+        blocks = _batched(chunks, self.buffer_size)
+        written = self._write_file(
+            f'{filename}{self._suffix}',
+            blocks,
+            timings,
+            compress=bool(self.compression),
+        )
+        if entries is not None:
+            start_index = perf_counter()
+            data = _pack_index(entries)
+            timings['index_pack'] += perf_counter() - start_index
+            self._write_file(f'{filename}.idx', [data], timings, binary=True)
+        if report:
+            self._write_file(f'{filename}.diagnostics', report, timings)
+        # Whatever wasn't spent resolving or doing I/O was spent rendering,
+        # the writer thread's time overlaps with all of that
+        timings['render'] += (
+            perf_counter()
+            - start
+            - sum(
+                v
+                for k, v in timings.items()
+                if k not in ('render', 'writer_thread')
+            )
+        )
+
+        self.stats.add(timings, counts)
         self.log.debug(
-            '_apply: zone=%s, num_records=%d', name, len(plan.changes)
+            '_write_rendered: filename=%s, %s',
+            filename,
+            ', '.join(
+                [f'{k}={v:.6f}s' for k, v in timings.items()]
+                + [f'{k}={v}' for k, v in counts.items()]
+            ),
         )
 
-        # Store it
-        self._zones.append(desired)
+        return written
+
+    def _unchanged(self, tmp, filename):
+        try:
+            if getsize(tmp) != getsize(filename):
+                return False
+        except FileNotFoundError:
+            return False
+        with open(tmp, 'rb') as new, open(filename, 'rb') as old:
+            while True:
+                block = new.read(self.buffer_size)
+                if block != old.read(self.buffer_size):
+                    return False
+                if not block:
+                    return True
+
+    def _compressor(self, fh):
+        level = self.compression_level
+        if self.compression == 'gzip':
+            from gzip import GzipFile
+
+            # Leave the name and time out of the header so that the same
+            # content always compresses to the same bytes
+            return TextIOWrapper(
+                GzipFile(
+                    filename='',
+                    mode='wb',
+                    compresslevel=9 if level is None else level,
+                    fileobj=fh,
+                    mtime=0,
+                )
+            )
+        from lzma import LZMAFile
+
+        return TextIOWrapper(LZMAFile(fh, 'wb', preset=level))
+
+    def _write_blocks(self, out, blocks, timings):
+        if not self.queue_depth:
+            for block in blocks:
+                start = perf_counter()
+                out.write(block)
+                timings['write'] += perf_counter() - start
+            return
+
+        # Render, pulling from blocks, here while a writer thread writes what's
+        # been queued so that the CPU and I/O overlap. The queue bounds how far
+        # ahead rendering can get
+        from queue import Queue
+
+        queue = Queue(maxsize=self.queue_depth)
+        failed = []
+
+        def writer():
+            while True:
+                block = queue.get()
+                if block is None:
+                    return
+                elif failed:
+                    # Keep draining so that the renderer never blocks
+                    continue
+                try:
+                    start = perf_counter()
+                    out.write(block)
+                    timings['writer_thread'] += perf_counter() - start
+                except BaseException as e:
+                    failed.append(e)
+
+        thread = Thread(target=writer, name=f'{self.id}-writer', daemon=True)
+        thread.start()
+        try:
+            for block in blocks:
+                start = perf_counter()
+                queue.put(block)
+                timings['queue_wait'] += perf_counter() - start
+                if failed:
+                    break
+        finally:
+            queue.put(None)
+            thread.join()
+        if failed:
+            raise failed[0]
+
+    def _write_file(
+        self, filename, blocks, timings=None, binary=False, compress=False
+    ):
+        if timings is None:
+            timings = defaultdict(float)
+        # Write to a temp file alongside the final one and then move it into
+        # place so that readers never see a partially written file
+        tmp = f'{filename}.{getpid()}.tmp'
+        try:
+            with open(tmp, 'wb' if binary or compress else 'w') as fh:
+                # Compression happens as the blocks are written
+                out = self._compressor(fh) if compress else fh
+                try:
+                    self._write_blocks(out, blocks, timings)
+                    start = perf_counter()
+                finally:
+                    if compress:
+                        # Finishes the compressed stream, leaving fh open. On
+                        # failure too, otherwise it'd try to flush into the
+                        # closed fh when it's collected
+                        out.close()
+                fh.flush()
+                timings['write'] += perf_counter() - start
+
+                start = perf_counter()
+                unchanged = self._unchanged(tmp, filename)
+                timings['compare'] += perf_counter() - start
+
+                if self.fsync and not unchanged:
+                    start = perf_counter()
+                    fsync(fh.fileno())
+                    timings['fsync'] += perf_counter() - start
+            if not unchanged:
+                start = perf_counter()
+                replace(tmp, filename)
+                timings['replace'] += perf_counter() - start
+        except BaseException:
+            # The temp file may never have been created
+            with suppress(FileNotFoundError):
+                remove(tmp)
+            raise
+
+        if unchanged:
+            # Leave the existing file, and its inode, alone
+            remove(tmp)
+            self.log.debug('_write_file: filename=%s, unchanged', filename)
+            return False
+
+        if self.fsync:
+            # Make sure the rename itself is durable
+            start = perf_counter()
+            fd = os_open(path.dirname(filename) or '.', O_RDONLY)
+            try:
+                fsync(fd)
+            finally:
+                close(fd)
+            timings['fsync'] += perf_counter() - start
+
+        self.log.debug(
+            '_write_file: filename=%s, fsync=%.6fs, replace=%.6fs',
+            filename,
+            timings['fsync'],
+            timings['replace'],
+        )
+
+        return True
+
+    def _index(self, zone):
+        start = perf_counter()
 
         # Add all of its records to our maps
-        for record in desired.records:
+        wildcards = 0
+        firsts = {}
+        signatures = defaultdict(list)
+        compact = []
+        stacked = {}
+        for record in zone.records:
+            _type = record._type
+            # Only hang on to what we need, not the full record
+            if _type in ('ALIAS', 'CNAME'):
+                value = record.value
+            elif self.dual_stack:
+                values = tuple(str(v) for v in record.values)
+                current = stacked.get(record.name)
+                if current is None:
+                    current = _Record(record.fqdn, _type, values[0], values)
+                    stacked[record.name] = current
+                elif _type == 'A':
+                    # Both families go in a single record, A first
+                    current._type = _type
+                    current.value = values[0]
+                    current.values = values + current.values
+                    continue
+                else:
+                    current.values += values
+                    continue
+                compact.append((record.name, current))
+                continue
+            else:
+                value = record.values[0]
+            compact.append(
+                (record.name, _Record(record.fqdn, _type, str(value)))
+            )
+
+        for name, record in compact:
+            _type = record._type
             fqdn = record.fqdn
             if fqdn[0] == '*':
-                regex = fqdn.replace('.', '\\.')
-                regex = re.compile(rf'^.{regex}$')
-                # We want longest match first, preferring A over AAAA so we'll
-                # prepend some bits to sort by here, the `-` is to reverse
-                # length and still allow type/the sort to be reverse=False
-                n = 1024 - len(fqdn)
-                self._wildcards.append((n, record._type, regex, record))
+                self._wildcards.add(record)
+                wildcards += 1
             else:
-                self._records[fqdn].append(record)
+                # Prefer A over AAAA when available, it's what we'll resolve
+                # to. CNAME should always stand alone
+                current = self._records.get(fqdn)
+                if current is None or _type < current._type:
+                    self._records[fqdn] = record
+
+            # We'll only write out the first record, by type, for each name
+            first = firsts.get(name)
+            if first is None or _type < first._type:
+                firsts[name] = record
+
+            if self.incremental:
+                value = record.value
+                if record.values is not None:
+                    value = ' '.join(record.values)
+                signatures[fqdn].append(f'{_type} {value}')
+
+        if self.incremental:
+            self._signatures[zone.name] = {
+                fqdn: ' '.join(sorted(sigs))
+                for fqdn, sigs in signatures.items()
+            }
+
+        self.stats.add(
+            timings={'index': perf_counter() - start},
+            counts={
+                'zones': 1,
+                'records': len(zone.records),
+                'wildcard_records': wildcards,
+            },
+        )
+
+        # In name order so that writing doesn't have to sort
+        return zone.name, [firsts[name] for name in sorted(firsts)]
+
+    def _sort(self):
+        start = perf_counter()
+
+        # Sort wildcards so that we match most specific
+        self._wildcards.sort()
+
+        self.stats.add(timings={'sort': perf_counter() - start})
+
+    def _apply(self, plan):
+        # Store the zone with its records
+        desired = plan.desired
+        name = desired.name
+
+        self.log.debug(
+            '_apply: zone=%s, num_records=%d', name, len(plan.changes)
+        )
+
+        zone = self._index(desired)
 
         # Mark it as seen
         try:
@@ -172,18 +1666,33 @@ class EtcHostsProvider(BaseProvider):
         except KeyError:
             pass
 
+        if self._writing_early:
+            self._write_ready(zone)
+            if not self._expected_zones:
+                self.log.debug('_apply: all zone data collected')
+                self.stats.add(counts=self._resolver.counts)
+                self.log.debug('_apply: stats %s', self.stats)
+            return True
+
+        self._zones.append(zone)
+
         if not self._expected_zones:
             # We've seen everything and we're ready to write out our data
             self.log.debug('_apply: all zone data collected')
 
-            # Sort A before AAAA, as we prefer A when available. CNAME should
-            # always stand alone
-            for records in self._records.values():
-                records.sort(key=lambda r: r._type)
+            profile = environ.get(PROFILE_ENV_VAR)
+            if profile:
+                from cProfile import Profile
 
-            # Sort wildcards longest first so that we match most specific
-            self._wildcards.sort(key=lambda w: w[0:2])
+                profiler = Profile()
+                profiler.enable()
 
+            self._sort()
             self._write()
 
+            if profile:
+                profiler.disable()
+                profiler.dump_stats(profile)
+                self.log.info('_apply: profile written to %s', profile)
+
         return True
@@ -2,17 +2,43 @@
 #
 #
 
-from os import path
+import re
+from collections import defaultdict
+from gzip import open as gzip_open
+from json import load, loads
+from lzma import open as lzma_open
+from os import environ, listdir, makedirs, path, remove, stat
 from os.path import isfile
+from pstats import Stats
 from shutil import rmtree
+from subprocess import run
+from sys import executable
 from tempfile import mkdtemp
+from threading import Event, Thread
+from types import SimpleNamespace
 from unittest import TestCase
+from unittest.mock import patch
 
+from octodns.provider import ProviderException
 from octodns.provider.plan import Plan
 from octodns.record import Record
 from octodns.zone import Zone
 
-from octodns_etchosts import EtcHostsProvider
+import octodns_etchosts
+from octodns_etchosts import (
+    _INDEX_HEADER,
+    PROFILE_ENV_VAR,
+    EtcHostsProvider,
+    HostsIndex,
+    _pack_index,
+    _Pending,
+    _Record,
+    _Resolver,
+    _WildcardIndex,
+)
+
+# The root of the repo, for running its scripts
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
 
 
 class TemporaryDirectory(object):
@@ -36,10 +62,10 @@ class TestEtcHostsProvider(TestCase):
 
         zone = Zone('unit.tests.', [])
 
-        # We never populate anything, when acting as a source
+        # We never populate anything when acting as a target
         source.populate(zone, target=source)
         self.assertEqual(0, len(zone.records))
-        # Same if we're acting as a target
+        # Nor as a source when there's no hosts file to read
         source.populate(zone)
         self.assertEqual(0, len(zone.records))
 
@@ -261,10 +287,10 @@ class TestEtcHostsProvider(TestCase):
 
         zone = Zone('unit.tests.', [])
 
-        # We never populate anything, when acting as a source
+        # We never populate anything when acting as a target
         source.populate(zone, target=source)
         self.assertEqual(0, len(zone.records))
-        # Same if we're acting as a target
+        # Nor as a source when there's no hosts file to read
         source.populate(zone)
         self.assertEqual(0, len(zone.records))
 
@@ -323,10 +349,10 @@ class TestEtcHostsProvider(TestCase):
 
         zone = Zone('unit.tests.', [])
 
-        # We never populate anything, when acting as a source
+        # We never populate anything when acting as a target
         source.populate(zone, target=source)
         self.assertEqual(0, len(zone.records))
-        # Same if we're acting as a target
+        # Nor as a source when there's no hosts file to read
         source.populate(zone)
         self.assertEqual(0, len(zone.records))
 
@@ -425,3 +451,1657 @@ class TestEtcHostsProvider(TestCase):
                 self.assertTrue('# middle.unit.tests. -> unit.tests.\n' in data)
                 self.assertTrue('# unit.tests. -> www.unit.tests.\n' in data)
                 self.assertTrue('1.1.1.1	start.unit.tests\n' in data)
+
+    def test_wildcard_index(self):
+        zone = Zone('unit.tests.', [])
+        records = []
+        for name, _type, value in (
+            ('*', 'AAAA', '2001:4860:4860::8888'),
+            ('*', 'A', '1.1.1.1'),
+            ('*.sub', 'A', '2.2.2.2'),
+            ('*.deep.sub', 'AAAA', '2001:4860:4860::8844'),
+            ('*.other', 'CNAME', 'www.unit.tests.'),
+            # irregular wildcards fall back to regex matching
+            ('*foo.sub', 'A', '3.3.3.3'),
+            ('*foo.sub', 'AAAA', '2001:4860:4860::8844'),
+            ('*bar.sub', 'A', '6.6.6.6'),
+            ('*long.suffix.sub', 'A', '7.7.7.7'),
+            ('*.*.x', 'A', '4.4.4.4'),
+            # More specific than *foo.sub
+            ('*.foo.sub', 'A', '5.5.5.5'),
+            # More specific than *.*.x
+            ('*.long.b.x', 'A', '8.8.8.8'),
+        ):
+            records.append(_Record(f'{name}.{zone.name}', _type, value))
+
+        index = _WildcardIndex()
+        wildcards = []
+        for record in records:
+            index.add(record)
+            regex = re.compile(rf'^.{record.fqdn.replace(".", "[.]")}$')
+            wildcards.append(
+                (1024 - len(record.fqdn), record._type, regex, record)
+            )
+        index.sort()
+        wildcards.sort(key=lambda w: w[0:2])
+
+        def expected(fqdn):
+            for _, _, regex, record in wildcards:
+                if regex.match(fqdn):
+                    return record
+            return None
+
+        for fqdn in (
+            'unit.tests.',
+            'www.unit.tests.',
+            'a.b.unit.tests.',
+            'sub.unit.tests.',
+            'foo.sub.unit.tests.',
+            'a.foo.sub.unit.tests.',
+            'xfoo.sub.unit.tests.',
+            'bar.sub.unit.tests.',
+            'a.long.suffix.sub.unit.tests.',
+            'x.x',
+            'a.long.b.x.unit.tests.',
+            'foo.deep.sub.unit.tests.',
+            'deep.sub.unit.tests.',
+            'foo.other.unit.tests.',
+            'a.b.x.unit.tests.',
+            'a..x.unit.tests.',
+            'foo.sub.unit.tests',
+            'github.com.',
+            '*.sub.unit.tests.',
+        ):
+            self.assertEqual(expected(fqdn), index.match(fqdn), fqdn)
+
+        # Specific expectations
+        self.assertEqual('1.1.1.1', index.match('www.unit.tests.').value)
+        self.assertEqual('2.2.2.2', index.match('a.b.sub.unit.tests.').value)
+        self.assertEqual('3.3.3.3', index.match('xfoo.sub.unit.tests.').value)
+        self.assertEqual('4.4.4.4', index.match('a.b.x.unit.tests.').value)
+        self.assertEqual('5.5.5.5', index.match('a.foo.sub.unit.tests.').value)
+        self.assertIsNone(index.match('github.com.'))
+        self.assertIsNone(_WildcardIndex().match('www.unit.tests.'))
+
+    def test_cname_chains_shared(self):
+        zone = Zone('unit.tests.', [])
+        other_zone = Zone('other.tests.', [])
+
+        # Same name & type in both zones, must not be mistaken for a loop
+        zone.add_record(
+            Record.new(
+                zone,
+                'www',
+                {'ttl': 60, 'type': 'CNAME', 'value': 'www.other.tests.'},
+            )
+        )
+        other_zone.add_record(
+            Record.new(
+                other_zone,
+                'www',
+                {'ttl': 60, 'type': 'CNAME', 'value': 'target.other.tests.'},
+            )
+        )
+        other_zone.add_record(
+            Record.new(
+                other_zone,
+                'target',
+                {'ttl': 60, 'type': 'A', 'value': '1.1.1.1'},
+            )
+        )
+        # Lots of things sharing the tail of the chain
+        for i in range(3):
+            zone.add_record(
+                Record.new(
+                    zone,
+                    f'shared{i}',
+                    {'ttl': 60, 'type': 'CNAME', 'value': 'www.unit.tests.'},
+                )
+            )
+        # A tail leading into a loop
+        for name, value in (
+            ('tail', 'first.unit.tests.'),
+            ('first', 'second.unit.tests.'),
+            ('second', 'first.unit.tests.'),
+        ):
+            zone.add_record(
+                Record.new(
+                    zone, name, {'ttl': 60, 'type': 'CNAME', 'value': value}
+                )
+            )
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'hosts')
+            hosts_file = path.join(directory, 'unit.tests.hosts')
+            target = EtcHostsProvider('test', directory)
+
+            plan = target.plan(zone)
+            other_plan = target.plan(other_zone)
+            target.apply(plan)
+            target.apply(other_plan)
+
+            with open(hosts_file) as fh:
+                data = fh.read()
+                self.assertTrue(
+                    '# www.unit.tests. -> www.other.tests.\n'
+                    '# www.other.tests. -> target.other.tests.\n'
+                    '1.1.1.1\twww.unit.tests\n' in data
+                )
+                for i in range(3):
+                    self.assertTrue(
+                        f'# shared{i}.unit.tests. -> www.unit.tests.\n'
+                        '# www.unit.tests. -> www.other.tests.\n'
+                        '# www.other.tests. -> target.other.tests.\n'
+                        f'1.1.1.1\tshared{i}.unit.tests\n' in data
+                    )
+                self.assertTrue(
+                    '# tail.unit.tests. -> first.unit.tests.\n'
+                    '# first.unit.tests. -> second.unit.tests.\n'
+                    '# second.unit.tests. -> first.unit.tests.\n'
+                    '# ** loop detected **\n' in data
+                )
+                self.assertTrue(
+                    '# second.unit.tests. -> first.unit.tests.\n'
+                    '# first.unit.tests. -> second.unit.tests.\n'
+                    '# ** loop detected **\n' in data
+                )
+
+    def test_buffer_size(self):
+        zone = Zone('unit.tests.', [])
+        for i in range(10):
+            zone.add_record(
+                Record.new(
+                    zone, f'a{i}', {'ttl': 60, 'type': 'A', 'value': '1.1.1.1'}
+                )
+            )
+            zone.add_record(
+                Record.new(
+                    zone,
+                    f'c{i}',
+                    {'ttl': 60, 'type': 'CNAME', 'value': f'a{i}.unit.tests.'},
+                )
+            )
+
+        datas = []
+        with TemporaryDirectory() as td:
+            for buffer_size in (1, 64, 1024 * 1024):
+                directory = path.join(td.dirname, str(buffer_size))
+                hosts_file = path.join(directory, 'unit.tests.hosts')
+                target = EtcHostsProvider(
+                    'test', directory, buffer_size=buffer_size
+                )
+                target.apply(target.plan(zone))
+                with open(hosts_file) as fh:
+                    datas.append(fh.read())
+
+        # Output doesn't depend on how it was batched
+        self.assertEqual(datas[0], datas[1])
+        self.assertEqual(datas[0], datas[2])
+        self.assertTrue('1.1.1.1\tc9.unit.tests\n' in datas[0])
+
+    def test_atomic_write(self):
+        zone = Zone('unit.tests.', [])
+        zone.add_record(
+            Record.new(
+                zone, 'www', {'ttl': 60, 'type': 'A', 'value': '1.1.1.1'}
+            )
+        )
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'hosts')
+            hosts_file = path.join(directory, 'unit.tests.hosts')
+            target = EtcHostsProvider('test', directory, fsync=True)
+            target.apply(target.plan(zone))
+
+            with open(hosts_file) as fh:
+                data = fh.read()
+                self.assertTrue('1.1.1.1\twww.unit.tests\n' in data)
+            # Only the final file is left behind
+            self.assertEqual(['unit.tests.hosts'], listdir(directory))
+
+            def blocks():
+                yield 'partial'
+                raise Exception('boom')
+
+            # A failure part way through leaves the existing file alone and
+            # cleans up after itself
+            with self.assertRaises(Exception) as ctx:
+                target._write_file(hosts_file, blocks())
+            self.assertEqual('boom', str(ctx.exception))
+            with open(hosts_file) as fh:
+                self.assertEqual(data, fh.read())
+            self.assertEqual(['unit.tests.hosts'], listdir(directory))
+
+            # Failing to create the temp file surfaces that error
+            missing = path.join(td.dirname, 'missing', 'unit.tests.hosts')
+            with self.assertRaises(FileNotFoundError) as ctx:
+                target._write_file(missing, blocks())
+            self.assertTrue(f'{missing}.' in str(ctx.exception))
+
+    def test_unchanged_not_rewritten(self):
+        zone = Zone('unit.tests.', [])
+        zone.add_record(
+            Record.new(
+                zone, 'www', {'ttl': 60, 'type': 'A', 'value': '1.1.1.1'}
+            )
+        )
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'hosts')
+            hosts_file = path.join(directory, 'unit.tests.hosts')
+
+            target = EtcHostsProvider('test', directory, buffer_size=8)
+            target.apply(target.plan(zone))
+            inode = stat(hosts_file).st_ino
+
+            # Same content, the file is left alone
+            target = EtcHostsProvider('test', directory, buffer_size=8)
+            with self.assertLogs(target.log, 'INFO') as logs:
+                target.apply(target.plan(zone))
+            self.assertTrue(
+                'INFO:EtcHostsProvider[test]:_write: written=0, unchanged=1'
+                in logs.output
+            )
+            self.assertEqual(inode, stat(hosts_file).st_ino)
+            self.assertEqual(['unit.tests.hosts'], listdir(directory))
+
+            # Same size, different content, it's rewritten
+            zone = Zone('unit.tests.', [])
+            zone.add_record(
+                Record.new(
+                    zone, 'www', {'ttl': 60, 'type': 'A', 'value': '2.2.2.2'}
+                )
+            )
+            target = EtcHostsProvider('test', directory, buffer_size=8)
+            with self.assertLogs(target.log, 'INFO') as logs:
+                target.apply(target.plan(zone))
+            self.assertTrue(
+                'INFO:EtcHostsProvider[test]:_write: written=1, unchanged=0'
+                in logs.output
+            )
+            with open(hosts_file) as fh:
+                self.assertTrue('2.2.2.2\twww.unit.tests\n' in fh.read())
+
+            # Different size, it's rewritten
+            zone.add_record(
+                Record.new(
+                    zone, 'v6', {'ttl': 60, 'type': 'AAAA', 'value': '::1'}
+                )
+            )
+            target = EtcHostsProvider('test', directory, buffer_size=8)
+            target.apply(target.plan(zone))
+            with open(hosts_file) as fh:
+                self.assertTrue('::1\tv6.unit.tests\n' in fh.read())
+
+    def test_workers(self):
+        zones = []
+        for i in range(5):
+            zone = Zone(f'zone{i}.tests.', [])
+            zone.add_record(
+                Record.new(
+                    zone, 'www', {'ttl': 60, 'type': 'A', 'value': f'1.1.1.{i}'}
+                )
+            )
+            # Point across to the next zone
+            zone.add_record(
+                Record.new(
+                    zone,
+                    'next',
+                    {
+                        'ttl': 60,
+                        'type': 'CNAME',
+                        'value': f'www.zone{(i + 1) % 5}.tests.',
+                    },
+                )
+            )
+            zones.append(zone)
+
+        datas = []
+        with TemporaryDirectory() as td:
+            for workers in (1, 3):
+                directory = path.join(td.dirname, str(workers))
+                target = EtcHostsProvider('test', directory, workers=workers)
+                plans = [target.plan(zone) for zone in zones]
+                for plan in plans:
+                    target.apply(plan)
+                data = {}
+                for zone in zones:
+                    hosts_file = path.join(directory, f'{zone.name}hosts')
+                    with open(hosts_file) as fh:
+                        data[zone.name] = fh.read()
+                datas.append(data)
+
+        # Same results either way
+        self.assertEqual(datas[0], datas[1])
+        self.assertTrue(
+            '# next.zone4.tests. -> www.zone0.tests.\n'
+            '1.1.1.0\tnext.zone4.tests\n' in datas[1]['zone4.tests.']
+        )
+
+    def test_combined_file(self):
+        zone = Zone('unit.tests.', [])
+        sub_zone = Zone('sub.unit.tests.', [])
+        for z, name, data in (
+            (zone, 'www', {'type': 'A', 'value': '1.1.1.1'}),
+            (zone, 'v6', {'type': 'AAAA', 'value': '::1'}),
+            (zone, 'alt', {'type': 'CNAME', 'value': 'www.unit.tests.'}),
+            (zone, 'nope', {'type': 'CNAME', 'value': 'github.com.'}),
+            (zone, 'loop', {'type': 'CNAME', 'value': 'loop.unit.tests.'}),
+            (zone, '*.wild', {'type': 'A', 'value': '3.3.3.3'}),
+            (zone, 'wild', {'type': 'CNAME', 'value': 'x.wild.unit.tests.'}),
+            # Overlaps with the sub zone
+            (zone, 'www.sub', {'type': 'A', 'value': '2.2.2.2'}),
+            (sub_zone, 'www', {'type': 'A', 'value': '2.2.2.2'}),
+            (sub_zone, 'other', {'type': 'A', 'value': '1.1.1.1'}),
+        ):
+            data['ttl'] = 60
+            z.add_record(Record.new(z, name, data))
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'hosts')
+            hosts_file = path.join(directory, 'hosts')
+
+            target = EtcHostsProvider('test', directory, combined_file='hosts')
+            plans = [target.plan(zone), target.plan(sub_zone)]
+            for plan in plans:
+                target.apply(plan)
+            # Only the combined file is written
+            self.assertEqual(['hosts'], listdir(directory))
+            with open(hosts_file) as fh:
+                self.assertEqual(
+                    '##################################################\n'
+                    '# octoDNS test\n'
+                    '##################################################\n\n'
+                    '1.1.1.1\talt.unit.tests\n'
+                    '::1\tv6.unit.tests\n'
+                    '3.3.3.3\twild.unit.tests\n'
+                    '1.1.1.1\twww.unit.tests\n'
+                    '2.2.2.2\twww.sub.unit.tests\n'
+                    '1.1.1.1\tother.sub.unit.tests\n',
+                    fh.read(),
+                )
+
+            target = EtcHostsProvider(
+                'test',
+                directory,
+                combined_file='hosts',
+                combined_names_per_line=2,
+            )
+            plans = [target.plan(zone), target.plan(sub_zone)]
+            for plan in plans:
+                target.apply(plan)
+            with open(hosts_file) as fh:
+                self.assertEqual(
+                    '##################################################\n'
+                    '# octoDNS test\n'
+                    '##################################################\n\n'
+                    '1.1.1.1\talt.unit.tests www.unit.tests\n'
+                    '::1\tv6.unit.tests\n'
+                    '3.3.3.3\twild.unit.tests\n'
+                    '2.2.2.2\twww.sub.unit.tests\n'
+                    '1.1.1.1\tother.sub.unit.tests\n',
+                    fh.read(),
+                )
+
+    def test_stats(self):
+        zone = Zone('unit.tests.', [])
+        for name, data in (
+            ('www', {'type': 'A', 'value': '1.1.1.1'}),
+            ('*.wild', {'type': 'A', 'value': '3.3.3.3'}),
+            ('alt', {'type': 'CNAME', 'value': 'www.unit.tests.'}),
+            ('alt2', {'type': 'CNAME', 'value': 'alt.unit.tests.'}),
+            ('wild', {'type': 'CNAME', 'value': 'x.wild.unit.tests.'}),
+            ('nope', {'type': 'CNAME', 'value': 'github.com.'}),
+            ('loop', {'type': 'CNAME', 'value': 'loop.unit.tests.'}),
+        ):
+            data['ttl'] = 60
+            zone.add_record(Record.new(zone, name, data))
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'hosts')
+            target = EtcHostsProvider('test', directory, fsync=True)
+            with self.assertLogs(target.log, 'DEBUG') as logs:
+                target.apply(target.plan(zone))
+
+            stats = target.stats
+            self.assertEqual(
+                {
+                    'zones': 1,
+                    'records': 7,
+                    'wildcard_records': 1,
+                    'loops': 1,
+                    'unavailable': 1,
+                    'wildcards': 1,
+                    'values': 4,
+                    'files_written': 1,
+                    'files_unchanged': 0,
+                    # each target is only looked up once
+                    'target_hits': 0,
+                    'target_misses': 5,
+                    'wildcard_lookups': 2,
+                    # alt2 reaches alt's cached chain
+                    'chain_hits': 1,
+                    'chains': 5,
+                },
+                dict(stats.counts),
+            )
+            self.assertEqual(
+                {
+                    'index',
+                    'sort',
+                    'resolve',
+                    'write',
+                    'compare',
+                    'fsync',
+                    'replace',
+                    'render',
+                },
+                set(stats.timings.keys()),
+            )
+            for v in stats.timings.values():
+                self.assertTrue(v >= 0)
+            self.assertTrue('loops=1' in repr(stats))
+            self.assertTrue(
+                [
+                    line
+                    for line in logs.output
+                    if '_write: stats timings: ' in line
+                ]
+            )
+
+            # Profiling is enabled through the environment
+            profile = path.join(td.dirname, 'etchosts.prof')
+            environ[PROFILE_ENV_VAR] = profile
+            try:
+                target = EtcHostsProvider('test', directory)
+                target.apply(target.plan(zone))
+            finally:
+                del environ[PROFILE_ENV_VAR]
+            self.assertTrue(isfile(profile))
+            Stats(profile)
+
+    def test_index_ordering(self):
+        zone = Zone('unit.tests.', [])
+        a = Record.new(
+            zone, 'www', {'ttl': 60, 'type': 'A', 'value': '1.1.1.1'}
+        )
+        aaaa = Record.new(
+            zone, 'www', {'ttl': 60, 'type': 'AAAA', 'value': '::1'}
+        )
+        alias = Record.new(
+            zone, '', {'ttl': 60, 'type': 'ALIAS', 'value': 'www.unit.tests.'}
+        )
+        other = Record.new(
+            zone, 'other', {'ttl': 60, 'type': 'A', 'value': '2.2.2.2'}
+        )
+
+        # Regardless of the order records come in the A is preferred and only
+        # the first of each name is kept, in name order
+        for records in ([a, aaaa, alias, other], [other, aaaa, alias, a]):
+            target = EtcHostsProvider('test', 'not-used')
+            indexed = target._index(
+                SimpleNamespace(name=zone.name, records=records)
+            )
+            record = target._records['www.unit.tests.']
+            self.assertEqual(
+                ('www.unit.tests.', 'A', '1.1.1.1'),
+                (record.fqdn, record._type, record.value),
+            )
+            # It's the compact version that's held on to, not the Record
+            self.assertIsInstance(record, _Record)
+            self.assertEqual(
+                '<_Record A www.unit.tests. 1.1.1.1>', repr(record)
+            )
+            name, records = indexed
+            self.assertEqual('unit.tests.', name)
+            self.assertEqual(
+                ['unit.tests.', 'other.unit.tests.', 'www.unit.tests.'],
+                [r.fqdn for r in records],
+            )
+            self.assertIs(record, records[2])
+
+    def test_incremental(self):
+        def zones(www='1.1.1.1', wildcard=False, extra=False):
+            zone = Zone('unit.tests.', [])
+            other_zone = Zone('other.tests.', [])
+            unrelated_zone = Zone('unrelated.tests.', [])
+            for z, name, data in (
+                (zone, 'alias', {'type': 'CNAME', 'value': 'www.other.tests.'}),
+                (zone, 'dangle', {'type': 'CNAME', 'value': 'x.sub.tests.'}),
+                # Shares alias's link
+                (zone, 'via', {'type': 'CNAME', 'value': 'alias.unit.tests.'}),
+                (other_zone, 'www', {'type': 'A', 'value': www}),
+                (unrelated_zone, 'www', {'type': 'A', 'value': '3.3.3.3'}),
+            ):
+                data['ttl'] = 60
+                z.add_record(Record.new(z, name, data))
+            if wildcard:
+                other_zone.add_record(
+                    Record.new(
+                        other_zone,
+                        '*.nothing',
+                        {'ttl': 60, 'type': 'A', 'value': '4.4.4.4'},
+                    )
+                )
+            if extra:
+                unrelated_zone.add_record(
+                    Record.new(
+                        unrelated_zone,
+                        'extra',
+                        {'ttl': 60, 'type': 'A', 'value': '5.5.5.5'},
+                    )
+                )
+            return [zone, other_zone, unrelated_zone]
+
+        def apply(zones, **kwargs):
+            target = EtcHostsProvider(
+                'test', directory, incremental=True, **kwargs
+            )
+            plans = [target.plan(zone) for zone in zones]
+            for plan in plans:
+                target.apply(plan)
+            return target
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'hosts')
+            hosts_file = path.join(directory, 'unit.tests.hosts')
+            state_file = path.join(directory, '.etchosts-state.json')
+
+            # First run, no state, everything is rendered
+            target = apply(zones())
+            self.assertEqual(0, target.stats.counts['zones_skipped'])
+            self.assertEqual(3, target.stats.counts['files_written'])
+            self.assertTrue(isfile(state_file))
+            with open(state_file) as fh:
+                state = load(fh)
+            self.assertEqual(
+                {
+                    'records': {
+                        'alias.unit.tests.': 'CNAME www.other.tests.',
+                        'dangle.unit.tests.': 'CNAME x.sub.tests.',
+                        'via.unit.tests.': 'CNAME alias.unit.tests.',
+                    },
+                    'dependencies': [
+                        'alias.unit.tests.',
+                        'www.other.tests.',
+                        'x.sub.tests.',
+                    ],
+                },
+                state['zones']['unit.tests.'],
+            )
+
+            # Nothing changed, nothing is rendered
+            target = apply(zones())
+            self.assertEqual(3, target.stats.counts['zones_skipped'])
+            self.assertEqual(0, target.stats.counts['files_written'])
+
+            # Something unit.tests. points to changes, it's rendered along
+            # with the zone that changed, unrelated is left alone
+            target = apply(zones(www='2.2.2.2'))
+            self.assertEqual(1, target.stats.counts['zones_skipped'])
+            self.assertEqual(2, target.stats.counts['files_written'])
+            with open(hosts_file) as fh:
+                self.assertTrue('2.2.2.2\talias.unit.tests\n' in fh.read())
+
+            # Only the unrelated zone changes
+            target = apply(zones(www='2.2.2.2', extra=True))
+            self.assertEqual(2, target.stats.counts['zones_skipped'])
+            self.assertEqual(1, target.stats.counts['files_written'])
+
+            # A wildcard that matches nothing anyone depends on
+            target = apply(zones(www='2.2.2.2', extra=True, wildcard=True))
+            self.assertEqual(2, target.stats.counts['zones_skipped'])
+            self.assertEqual(1, target.stats.counts['files_written'])
+
+            # Missing files are rendered
+            remove(hosts_file)
+            target = apply(zones(www='2.2.2.2', extra=True, wildcard=True))
+            self.assertEqual(2, target.stats.counts['zones_skipped'])
+            self.assertTrue(isfile(hosts_file))
+
+            # Changing options that impact output renders everything
+            target = apply(
+                zones(www='2.2.2.2', extra=True, wildcard=True),
+                remove_trailing_dots=False,
+            )
+            self.assertEqual(0, target.stats.counts['zones_skipped'])
+
+            # As does a state file that can't be read
+            with open(state_file, 'w') as fh:
+                fh.write('not json')
+            with self.assertLogs('EtcHostsProvider[test]', 'WARNING'):
+                target = apply(zones(www='2.2.2.2', extra=True, wildcard=True))
+            self.assertEqual(0, target.stats.counts['zones_skipped'])
+
+            # A new, empty, zone is rendered
+            target = EtcHostsProvider('test', directory, incremental=True)
+            for zone in zones(www='2.2.2.2', extra=True, wildcard=True) + [
+                Zone('empty.tests.', [])
+            ]:
+                target._zones.append(target._index(zone))
+            target._sort()
+            target._write()
+            self.assertEqual(3, target.stats.counts['zones_skipped'])
+            self.assertTrue(isfile(path.join(directory, 'empty.tests.hosts')))
+
+            # combined_file doesn't support incremental
+            target = apply(zones(www='2.2.2.2'), combined_file='hosts')
+            self.assertFalse('zones_skipped' in target.stats.counts)
+
+    def test_incremental_wildcards(self):
+        zone = Zone('unit.tests.', [])
+        zone.add_record(
+            Record.new(
+                zone,
+                'dangle',
+                {'ttl': 60, 'type': 'CNAME', 'value': 'x.sub.other.tests.'},
+            )
+        )
+        other_zone = Zone('other.tests.', [])
+        other_zone.add_record(
+            Record.new(
+                other_zone, 'www', {'ttl': 60, 'type': 'A', 'value': '1.1.1.1'}
+            )
+        )
+        unrelated_zone = Zone('unrelated.tests.', [])
+        unrelated_zone.add_record(
+            Record.new(
+                unrelated_zone,
+                'www',
+                {'ttl': 60, 'type': 'A', 'value': '1.1.1.1'},
+            )
+        )
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'hosts')
+            hosts_file = path.join(directory, 'unit.tests.hosts')
+
+            target = EtcHostsProvider('test', directory, incremental=True)
+            plans = [target.plan(z) for z in (zone, other_zone, unrelated_zone)]
+            for plan in plans:
+                target.apply(plan)
+            with open(hosts_file) as fh:
+                self.assertTrue('# ** unavailable **' in fh.read())
+
+            # A new wildcard that matches what we were pointing at
+            other_zone.add_record(
+                Record.new(
+                    other_zone,
+                    '*.sub',
+                    {'ttl': 60, 'type': 'A', 'value': '4.4.4.4'},
+                )
+            )
+            target = EtcHostsProvider('test', directory, incremental=True)
+            plans = [target.plan(z) for z in (zone, other_zone, unrelated_zone)]
+            for plan in plans:
+                target.apply(plan)
+            self.assertEqual(1, target.stats.counts['zones_skipped'])
+            with open(hosts_file) as fh:
+                self.assertTrue('4.4.4.4\tdangle.unit.tests\n' in fh.read())
+
+    def test_write_early(self):
+        zones = []
+        for i in range(5):
+            zone = Zone(f'zone{i}.tests.', [])
+            zone.add_record(
+                Record.new(
+                    zone, 'www', {'ttl': 60, 'type': 'A', 'value': f'1.1.1.{i}'}
+                )
+            )
+            # Point across to the next zone
+            zone.add_record(
+                Record.new(
+                    zone,
+                    'next',
+                    {
+                        'ttl': 60,
+                        'type': 'CNAME',
+                        'value': f'www.zone{(i + 1) % 5}.tests.',
+                    },
+                )
+            )
+            zones.append(zone)
+
+        def read(directory):
+            data = {}
+            for filename in listdir(directory):
+                with open(path.join(directory, filename)) as fh:
+                    data[filename] = fh.read()
+            return data
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'all')
+            target = EtcHostsProvider('test', directory)
+            for plan in [target.plan(zone) for zone in zones]:
+                target.apply(plan)
+            expected = read(directory)
+
+            for workers in (1, 3):
+                directory = path.join(td.dirname, str(workers))
+                if workers > 1:
+                    # Whether or not the directory already exists
+                    makedirs(directory)
+                target = EtcHostsProvider(
+                    'test', directory, workers=workers, write_early=True
+                )
+                plans = [target.plan(zone) for zone in zones]
+
+                # zone0 has to wait for zone1 to know where next goes
+                target.apply(plans[0])
+                self.assertEqual([], listdir(directory))
+                self.assertEqual(1, target.stats.counts['zones_deferred'])
+
+                # Once it's been seen zone0 is written, but zone1 now waits
+                target.apply(plans[1])
+                self.assertEqual(['zone0.tests.hosts'], listdir(directory))
+                self.assertEqual(2, target.stats.counts['zones_deferred'])
+                self.assertEqual(1, target.stats.counts['files_written'])
+
+                target.apply(plans[2])
+                target.apply(plans[3])
+                self.assertEqual(3, len(listdir(directory)))
+
+                # zone4 points back to zone0 so it's written immediately
+                # along with zone3 that was waiting on it
+                target.apply(plans[4])
+                self.assertEqual(expected, read(directory))
+                self.assertEqual(5, target.stats.counts['files_written'])
+                self.assertEqual(4, target.stats.counts['zones_deferred'])
+                self.assertEqual(5, target.stats.counts['chains'])
+
+            # Combined and incremental need everything and write at the end
+            for kwargs in ({'combined_file': 'hosts'}, {'incremental': True}):
+                directory = path.join(td.dirname, list(kwargs)[0])
+                target = EtcHostsProvider(
+                    'test', directory, write_early=True, **kwargs
+                )
+                plans = [target.plan(zone) for zone in zones]
+                target.apply(plans[0])
+                target.apply(plans[1])
+                self.assertFalse(path.exists(directory))
+
+        # Nothing under a pending zone is looked up, including subdomains of
+        # it, anything else is fine
+        resolver = _Resolver({}, _WildcardIndex(), {'zone1.tests.'})
+        self.assertEqual('zone1.tests.', resolver.pending_zone('zone1.tests.'))
+        self.assertEqual(
+            'zone1.tests.', resolver.pending_zone('a.b.zone1.tests.')
+        )
+        self.assertIsNone(resolver.pending_zone('zone2.tests.'))
+        self.assertIsNone(resolver.pending_zone('tests'))
+        with self.assertRaises(_Pending) as ctx:
+            resolver.lookup('www.zone1.tests.')
+        self.assertEqual('zone1.tests.', ctx.exception.zone)
+        self.assertIsNone(resolver.lookup('www.zone2.tests.'))
+
+    def test_source(self):
+        zone = Zone('unit.tests.', [])
+        for name, data in (
+            ('', {'type': 'ALIAS', 'value': 'www.unit.tests.'}),
+            ('www', {'type': 'A', 'values': ['1.1.1.1', '2.2.2.2']}),
+            ('www', {'type': 'AAAA', 'value': '2001:4860:4860::8888'}),
+            ('v6', {'type': 'AAAA', 'value': '2001:4860:4860::8844'}),
+            ('start', {'type': 'CNAME', 'value': 'middle.unit.tests.'}),
+            ('middle', {'type': 'CNAME', 'value': 'unit.tests.'}),
+            ('ext', {'type': 'CNAME', 'value': 'github.com.'}),
+            ('loop', {'type': 'CNAME', 'value': 'loop.unit.tests.'}),
+            ('*', {'type': 'A', 'value': '3.3.3.3'}),
+            ('*.sub', {'type': 'CNAME', 'value': 'v6.unit.tests.'}),
+            ('*.nowhere', {'type': 'CNAME', 'value': 'github.com.'}),
+            ('wild', {'type': 'CNAME', 'value': 'foo.sub.unit.tests.'}),
+        ):
+            zone.add_record(Record.new(zone, name, {'ttl': 60, **data}))
+
+        with TemporaryDirectory() as td:
+            for remove_trailing_dots in (True, False):
+                directory = path.join(td.dirname, str(remove_trailing_dots))
+                target = EtcHostsProvider(
+                    'test', directory, remove_trailing_dots
+                )
+                target.apply(target.plan(zone))
+
+                source = EtcHostsProvider('test', directory, source_ttl=42)
+                # Nothing is read back when acting as a target
+                copy = Zone('unit.tests.', [])
+                self.assertFalse(source.populate(copy, target=True))
+                self.assertEqual(0, len(copy.records))
+
+                self.assertTrue(source.populate(copy))
+                self.assertEqual(
+                    {
+                        ('', 'ALIAS', 'www.unit.tests.'),
+                        # Only the first value, and type, of each name
+                        ('www', 'A', '1.1.1.1'),
+                        ('v6', 'AAAA', '2001:4860:4860::8844'),
+                        ('start', 'CNAME', 'middle.unit.tests.'),
+                        ('middle', 'CNAME', 'unit.tests.'),
+                        ('ext', 'CNAME', 'github.com.'),
+                        ('loop', 'CNAME', 'loop.unit.tests.'),
+                        ('*', 'A', '3.3.3.3'),
+                        ('*.sub', 'CNAME', 'v6.unit.tests.'),
+                        ('*.nowhere', 'CNAME', 'github.com.'),
+                        ('wild', 'CNAME', 'foo.sub.unit.tests.'),
+                    },
+                    {
+                        (
+                            r.name,
+                            r._type,
+                            (
+                                r.value
+                                if r._type in ('ALIAS', 'CNAME')
+                                else r.values[0]
+                            ),
+                        )
+                        for r in copy.records
+                    },
+                )
+                self.assertEqual({42}, {r.ttl for r in copy.records})
+                self.assertEqual(11, source.stats.counts['populated_records'])
+
+                # Writing what was read gives back the same file
+                directory = path.join(directory, 'again')
+                target = EtcHostsProvider(
+                    'test', directory, remove_trailing_dots
+                )
+                target.apply(target.plan(copy))
+                with open(path.join(directory, 'unit.tests.hosts')) as fh:
+                    again = fh.read()
+                with open(path.join(directory, '..', 'unit.tests.hosts')) as fh:
+                    self.assertEqual(fh.read(), again)
+
+            # A zone that hasn't been written isn't found
+            self.assertFalse(source.populate(Zone('other.tests.', [])))
+
+    def test_binary_index(self):
+        zones = []
+        for i in range(2):
+            zone = Zone(f'zone{i}.tests.', [])
+            for name, data in (
+                ('', {'type': 'ALIAS', 'value': f'www.zone{i}.tests.'}),
+                ('www', {'type': 'A', 'values': ['1.1.1.1', '2.2.2.2']}),
+                ('v6', {'type': 'AAAA', 'value': '2001:4860:4860::8844'}),
+                ('other', {'type': 'A', 'value': f'3.3.3.{i}'}),
+                ('ext', {'type': 'CNAME', 'value': 'github.com.'}),
+                ('*.sub', {'type': 'A', 'value': '4.4.4.4'}),
+                ('wild', {'type': 'CNAME', 'value': f'x.sub.zone{i}.tests.'}),
+            ):
+                zone.add_record(Record.new(zone, name, {'ttl': 60, **data}))
+            zones.append(zone)
+
+        def apply(directory, **kwargs):
+            target = EtcHostsProvider(
+                'test', directory, binary_index=True, **kwargs
+            )
+            for plan in [target.plan(zone) for zone in zones]:
+                target.apply(plan)
+            return target
+
+        with TemporaryDirectory() as td:
+            for remove_trailing_dots in (True, False):
+                directory = path.join(td.dirname, str(remove_trailing_dots))
+                apply(directory, remove_trailing_dots=remove_trailing_dots)
+                dot = '' if remove_trailing_dots else '.'
+
+                filename = path.join(directory, 'zone0.tests.hosts')
+                with open(filename) as fh:
+                    lines = {
+                        tuple(line.strip().split('\t')[::-1])
+                        for line in fh
+                        if '\t' in line
+                    }
+                with HostsIndex(f'{filename}.idx') as index:
+                    # Everything in the hosts file and nothing else
+                    self.assertEqual(5, len(index))
+                    self.assertEqual(lines, set(index))
+                    self.assertEqual(
+                        ['1.1.1.1'], index.lookup(f'zone0.tests{dot}')
+                    )
+                    self.assertEqual(
+                        ['2001:4860:4860::8844'],
+                        index.lookup(f'v6.zone0.tests{dot}'),
+                    )
+                    self.assertEqual(
+                        ['4.4.4.4'], index.lookup(f'wild.zone0.tests{dot}')
+                    )
+                    for missing in ('a', 'ext.zone0.tests', 'zzz', ''):
+                        self.assertEqual([], index.lookup(missing))
+
+            # Re-writing leaves the unchanged index alone
+            before = stat(f'{filename}.idx').st_ino
+            apply(directory, remove_trailing_dots=False)
+            self.assertEqual(before, stat(f'{filename}.idx').st_ino)
+
+            # Combined gets a single index with everything in it
+            directory = path.join(td.dirname, 'combined')
+            apply(directory, combined_file='hosts')
+            self.assertEqual(['hosts', 'hosts.idx'], sorted(listdir(directory)))
+            with HostsIndex(path.join(directory, 'hosts.idx')) as index:
+                self.assertEqual(10, len(index))
+                self.assertEqual(['1.1.1.1'], index.lookup('www.zone0.tests'))
+                self.assertEqual(['3.3.3.1'], index.lookup('other.zone1.tests'))
+
+            # Names can have multiple addresses
+            filename = path.join(directory, 'multi.idx')
+            with open(filename, 'wb') as fh:
+                fh.write(
+                    _pack_index(
+                        [('b', '2.2.2.2'), ('a', '::1'), ('b', '1.1.1.1')]
+                    )
+                )
+            with HostsIndex(filename) as index:
+                self.assertEqual(['1.1.1.1', '2.2.2.2'], index.lookup('b'))
+                self.assertEqual(['::1'], index.lookup('a'))
+
+            # Things that aren't indexes are rejected
+            filename = path.join(directory, 'hosts')
+            with self.assertRaisesRegex(ValueError, 'is not a hosts index'):
+                HostsIndex(filename)
+            with open(filename, 'wb') as fh:
+                fh.write(b'OCTOHIDX')
+            with self.assertRaisesRegex(ValueError, 'is not a hosts index'):
+                HostsIndex(filename)
+            with open(filename, 'wb') as fh:
+                fh.write(_INDEX_HEADER.pack(b'OCTOHIDX', 42, 0))
+            with self.assertRaisesRegex(ValueError, 'index version 42, not 1'):
+                HostsIndex(filename)
+
+    def test_compression(self):
+        zone = Zone('unit.tests.', [])
+        for name, data in (
+            ('', {'type': 'ALIAS', 'value': 'www.unit.tests.'}),
+            ('www', {'type': 'A', 'value': '1.1.1.1'}),
+            ('v6', {'type': 'AAAA', 'value': '2001:4860:4860::8844'}),
+            ('ext', {'type': 'CNAME', 'value': 'github.com.'}),
+        ):
+            zone.add_record(Record.new(zone, name, {'ttl': 60, **data}))
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'plain')
+            target = EtcHostsProvider('test', directory)
+            target.apply(target.plan(zone))
+            with open(path.join(directory, 'unit.tests.hosts')) as fh:
+                expected = fh.read()
+
+            for compression, level, suffix, decompress in (
+                ('gzip', None, '.gz', gzip_open),
+                ('gzip', 1, '.gz', gzip_open),
+                ('lzma', None, '.xz', lzma_open),
+                ('lzma', 9, '.xz', lzma_open),
+            ):
+                directory = path.join(td.dirname, f'{compression}-{level}')
+                filename = path.join(directory, f'unit.tests.hosts{suffix}')
+                for _ in range(2):
+                    target = EtcHostsProvider(
+                        'test',
+                        directory,
+                        compression=compression,
+                        compression_level=level,
+                    )
+                    target.apply(target.plan(zone))
+                self.assertEqual([path.basename(filename)], listdir(directory))
+                with decompress(filename, 'rt') as fh:
+                    self.assertEqual(expected, fh.read())
+                # The same content compresses to the same bytes so the second
+                # run left the file alone
+                self.assertEqual(1, target.stats.counts['files_unchanged'])
+
+                # And it can be read back as a source
+                copy = Zone('unit.tests.', [])
+                self.assertTrue(target.populate(copy))
+                self.assertEqual(4, len(copy.records))
+
+            def blocks():
+                yield 'partial'
+                raise Exception('boom')
+
+            # A failure part way through closes the compressed stream rather
+            # than leaving it to be flushed into a closed file when it's
+            # collected
+            compressors = []
+            compressor = target._compressor
+
+            def capture(fh):
+                compressors.append(compressor(fh))
+                return compressors[-1]
+
+            with patch.object(target, '_compressor', capture):
+                with self.assertRaisesRegex(Exception, 'boom'):
+                    target._write_file(filename, blocks(), compress=True)
+            self.assertTrue(compressors[0].closed)
+            self.assertEqual([path.basename(filename)], listdir(directory))
+
+        with self.assertRaisesRegex(
+            ProviderException, 'Unsupported compression zstd'
+        ):
+            EtcHostsProvider('test', 'not-used', compression='zstd')
+        with self.assertRaisesRegex(
+            ProviderException, 'Unsupported compression_level 12, must be 0-9'
+        ):
+            EtcHostsProvider(
+                'test', 'not-used', compression='gzip', compression_level=12
+            )
+
+    def test_verbosity(self):
+        zone = Zone('unit.tests.', [])
+        for name, data in (
+            ('', {'type': 'ALIAS', 'value': 'www.unit.tests.'}),
+            ('www', {'type': 'A', 'value': '1.1.1.1'}),
+            ('v6', {'type': 'AAAA', 'value': '2001:4860:4860::8844'}),
+            ('ext', {'type': 'CNAME', 'value': 'github.com.'}),
+            ('loop', {'type': 'CNAME', 'value': 'loop.unit.tests.'}),
+            ('*.sub', {'type': 'A', 'value': '3.3.3.3'}),
+            ('wild', {'type': 'CNAME', 'value': 'foo.sub.unit.tests.'}),
+        ):
+            zone.add_record(Record.new(zone, name, {'ttl': 60, **data}))
+
+        def apply(directory, **kwargs):
+            target = EtcHostsProvider('test', directory, **kwargs)
+            target.apply(target.plan(zone))
+            return target
+
+        def read(filename):
+            with open(filename) as fh:
+                return fh.read()
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'full')
+            apply(directory)
+            self.assertEqual(['unit.tests.hosts'], listdir(directory))
+            full = read(path.join(directory, 'unit.tests.hosts'))
+
+            directory = path.join(td.dirname, 'minimal')
+            target = apply(directory, verbosity='minimal')
+            self.assertEqual(['unit.tests.hosts'], listdir(directory))
+            self.assertEqual(
+                '1.1.1.1\tunit.tests\n'
+                '2001:4860:4860::8844\tv6.unit.tests\n'
+                '3.3.3.3\twild.unit.tests\n'
+                '1.1.1.1\twww.unit.tests\n',
+                read(path.join(directory, 'unit.tests.hosts')),
+            )
+            # What was left out is still counted
+            self.assertEqual(1, target.stats.counts['loops'])
+            self.assertEqual(1, target.stats.counts['unavailable'])
+            self.assertEqual(1, target.stats.counts['wildcards'])
+            # It can't be read back, it'd all come back as A/AAAA
+            copy = Zone('unit.tests.', [])
+            with self.assertLogs('EtcHostsProvider[test]', 'WARNING'):
+                self.assertFalse(target.populate(copy))
+            self.assertEqual(0, len(copy.records))
+
+            directory = path.join(td.dirname, 'diagnostics')
+            apply(directory, verbosity='minimal', diagnostics=True)
+            report = read(path.join(directory, 'unit.tests.hosts.diagnostics'))
+            # The report has everything that isn't a plain value
+            self.assertEqual(
+                full.replace(
+                    '2001:4860:4860::8844\tv6.unit.tests\n\n', ''
+                ).replace('1.1.1.1\twww.unit.tests\n\n', ''),
+                report,
+            )
+            self.assertTrue(
+                '# ext.unit.tests. -> github.com.\n# ** unavailable **\n\n'
+                in report
+            )
+
+            # Combined only loses its header
+            directory = path.join(td.dirname, 'combined')
+            apply(directory, verbosity='minimal', combined_file='hosts')
+            self.assertEqual(
+                '1.1.1.1\tunit.tests\n'
+                '2001:4860:4860::8844\tv6.unit.tests\n'
+                '3.3.3.3\twild.unit.tests\n'
+                '1.1.1.1\twww.unit.tests\n',
+                read(path.join(directory, 'hosts')),
+            )
+
+        with self.assertRaisesRegex(
+            ProviderException, 'Unsupported verbosity loud'
+        ):
+            EtcHostsProvider('test', 'not-used', verbosity='loud')
+
+        # Full output has nothing to leave out for a report
+        with self.assertRaisesRegex(
+            ProviderException, 'diagnostics requires minimal verbosity'
+        ):
+            EtcHostsProvider('test', 'not-used', diagnostics=True)
+
+    def test_dual_stack(self):
+        zone = Zone('unit.tests.', [])
+        records = [
+            Record.new(zone, name, {'ttl': 60, **data})
+            for name, data in (
+                ('', {'type': 'ALIAS', 'value': 'www.unit.tests.'}),
+                ('www', {'type': 'AAAA', 'values': ['::1', '::2']}),
+                ('www', {'type': 'A', 'values': ['1.1.1.1', '2.2.2.2']}),
+                ('v4', {'type': 'A', 'value': '3.3.3.3'}),
+                ('v6', {'type': 'AAAA', 'value': '::3'}),
+                ('*.sub', {'type': 'A', 'value': '4.4.4.4'}),
+                ('*.sub', {'type': 'AAAA', 'value': '::4'}),
+                ('wild', {'type': 'CNAME', 'value': 'foo.sub.unit.tests.'}),
+            )
+        ]
+        for record in records:
+            zone.add_record(record)
+
+        # Regardless of the order they come in A's are first
+        for ordered in (records, records[::-1]):
+            target = EtcHostsProvider('test', 'not-used', dual_stack=True)
+            _, indexed = target._index(
+                SimpleNamespace(name=zone.name, records=ordered)
+            )
+            self.assertEqual(
+                [
+                    ('unit.tests.', 'ALIAS', 'www.unit.tests.', None),
+                    ('*.sub.unit.tests.', 'A', '4.4.4.4', ('4.4.4.4', '::4')),
+                    ('v4.unit.tests.', 'A', '3.3.3.3', ('3.3.3.3',)),
+                    ('v6.unit.tests.', 'AAAA', '::3', ('::3',)),
+                    ('wild.unit.tests.', 'CNAME', 'foo.sub.unit.tests.', None),
+                    (
+                        'www.unit.tests.',
+                        'A',
+                        '1.1.1.1',
+                        ('1.1.1.1', '2.2.2.2', '::1', '::2'),
+                    ),
+                ],
+                [(r.fqdn, r._type, r.value, r.values) for r in indexed],
+            )
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'zone')
+            target = EtcHostsProvider(
+                'test', directory, dual_stack=True, binary_index=True
+            )
+            target.apply(target.plan(zone))
+            filename = path.join(directory, 'unit.tests.hosts')
+            with open(filename) as fh:
+                data = fh.read()
+            # Everything at the end of the chain
+            self.assertTrue(
+                '# unit.tests. -> www.unit.tests.\n'
+                '1.1.1.1\tunit.tests\n'
+                '2.2.2.2\tunit.tests\n'
+                '::1\tunit.tests\n'
+                '::2\tunit.tests\n\n' in data
+            )
+            self.assertTrue(
+                '# *.sub.unit.tests.\n'
+                '4.4.4.4\twild.unit.tests\n'
+                '::4\twild.unit.tests\n\n' in data
+            )
+            self.assertTrue('::3\tv6.unit.tests\n\n' in data)
+            # Wildcards note all of their values too
+            self.assertTrue(
+                '# 4.4.4.4 -> *.sub.unit.tests.\n'
+                '# ::4 -> *.sub.unit.tests.\n'
+                '# ** wildcard **\n\n' in data
+            )
+            self.assertEqual(12, target.stats.counts['values'])
+            with HostsIndex(f'{filename}.idx') as index:
+                self.assertEqual(
+                    ['1.1.1.1', '2.2.2.2', '::1', '::2'],
+                    index.lookup('www.unit.tests'),
+                )
+
+            # Reading it back gets all of the values
+            copy = Zone('unit.tests.', [])
+            target.populate(copy)
+            www = {r._type: r.values for r in copy.records if r.name == 'www'}
+            self.assertEqual(
+                {'A': ['1.1.1.1', '2.2.2.2'], 'AAAA': ['::1', '::2']}, www
+            )
+            wildcard = {
+                r._type: r.values for r in copy.records if r.name == '*.sub'
+            }
+            self.assertEqual({'A': ['4.4.4.4'], 'AAAA': ['::4']}, wildcard)
+            # And writing what was read back gives the same file
+            directory = path.join(td.dirname, 'copy')
+            rewrite = EtcHostsProvider('test', directory, dual_stack=True)
+            rewrite.apply(rewrite.plan(copy))
+            with open(path.join(directory, 'unit.tests.hosts')) as fh:
+                self.assertEqual(data, fh.read())
+
+            directory = path.join(td.dirname, 'combined')
+            target = EtcHostsProvider(
+                'test',
+                directory,
+                dual_stack=True,
+                combined_file='hosts',
+                combined_names_per_line=2,
+            )
+            target.apply(target.plan(zone))
+            with open(path.join(directory, 'hosts')) as fh:
+                data = fh.read()
+            self.assertTrue('1.1.1.1\tunit.tests www.unit.tests\n' in data)
+            self.assertTrue('::2\tunit.tests www.unit.tests\n' in data)
+            self.assertTrue('::4\twild.unit.tests\n' in data)
+
+            # Changing any of the values re-renders incrementally
+            directory = path.join(td.dirname, 'incremental')
+            for value, skipped in (('::2', 0), ('::2', 1), ('::5', 0)):
+                changed = Zone('unit.tests.', [])
+                for record in records:
+                    changed.add_record(record)
+                changed.add_record(
+                    Record.new(
+                        changed,
+                        'www',
+                        {'ttl': 60, 'type': 'AAAA', 'values': ['::1', value]},
+                    ),
+                    replace=True,
+                )
+                target = EtcHostsProvider(
+                    'test', directory, dual_stack=True, incremental=True
+                )
+                target.apply(target.plan(changed))
+                self.assertEqual(skipped, target.stats.counts['zones_skipped'])
+
+    def test_queue_depth(self):
+        zone = Zone('unit.tests.', [])
+        for i in range(50):
+            zone.add_record(
+                Record.new(
+                    zone, f'a{i}', {'ttl': 60, 'type': 'A', 'value': '1.1.1.1'}
+                )
+            )
+            zone.add_record(
+                Record.new(
+                    zone,
+                    f'c{i}',
+                    {'ttl': 60, 'type': 'CNAME', 'value': f'a{i}.unit.tests.'},
+                )
+            )
+
+        datas = []
+        with TemporaryDirectory() as td:
+            for queue_depth in (0, 2):
+                directory = path.join(td.dirname, str(queue_depth))
+                target = EtcHostsProvider(
+                    'test', directory, buffer_size=64, queue_depth=queue_depth
+                )
+                target.apply(target.plan(zone))
+                with open(path.join(directory, 'unit.tests.hosts')) as fh:
+                    datas.append(fh.read())
+        # Same results either way
+        self.assertEqual(datas[0], datas[1])
+        # The writes happened in the writer thread
+        self.assertTrue(target.stats.timings['writer_thread'] > 0)
+        self.assertTrue('queue_wait' in target.stats.timings)
+
+        class Out(object):
+            def __init__(self):
+                self.blocks = []
+
+            def write(self, block):
+                if block == 'bad':
+                    raise OSError('disk full')
+                self.blocks.append(block)
+
+        def blocks(*blocks):
+            for block in blocks:
+                if block == 'boom':
+                    raise ValueError('render failed')
+                yield block
+
+        # Write failures stop rendering and are raised. With room for a single
+        # block putting c waits for the writer to take b, which it only does
+        # once it's recorded bad's failure, so rendering always sees it
+        target = EtcHostsProvider('test', 'not-used', queue_depth=1)
+        out = Out()
+        with self.assertRaisesRegex(OSError, 'disk full'):
+            target._write_blocks(
+                out, blocks('a', 'bad', 'b', 'c'), defaultdict(float)
+            )
+        self.assertEqual(['a'], out.blocks)
+
+        # As are render failures, after what was rendered is written
+        out = Out()
+        with self.assertRaisesRegex(ValueError, 'render failed'):
+            target._write_blocks(
+                out, blocks('a', 'b', 'boom'), defaultdict(float)
+            )
+        self.assertEqual(['a', 'b'], out.blocks)
+
+    def test_lint(self):
+        zone = Zone('unit.tests.', [])
+        for name, data in (
+            ('www', {'type': 'A', 'value': '1.1.1.1'}),
+            ('a', {'type': 'CNAME', 'value': 'b.unit.tests.'}),
+            ('b', {'type': 'CNAME', 'value': 'c.unit.tests.'}),
+            ('c', {'type': 'CNAME', 'value': 'a.unit.tests.'}),
+            ('into', {'type': 'CNAME', 'value': 'b.unit.tests.'}),
+            ('self', {'type': 'CNAME', 'value': 'self.unit.tests.'}),
+            ('ext', {'type': 'CNAME', 'value': 'github.com.'}),
+            ('to-ext', {'type': 'CNAME', 'value': 'ext.unit.tests.'}),
+            ('x', {'type': 'CNAME', 'value': 'y.unit.tests.'}),
+            ('y', {'type': 'CNAME', 'value': 'z.unit.tests.'}),
+            ('z', {'type': 'CNAME', 'value': 'www.unit.tests.'}),
+        ):
+            zone.add_record(Record.new(zone, name, {'ttl': 60, **data}))
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'report')
+            target = EtcHostsProvider(
+                'test',
+                directory,
+                lint_report='lint.json',
+                lint_max_depth=2,
+                write_early=True,
+            )
+            target.apply(target.plan(zone))
+            with open(path.join(directory, 'lint.json')) as fh:
+                report = load(fh)
+            self.assertEqual(
+                {
+                    'loops': [
+                        ['a.unit.tests.', 'b.unit.tests.', 'c.unit.tests.'],
+                        ['self.unit.tests.'],
+                    ],
+                    'dangling': [
+                        {'fqdn': 'ext.unit.tests.', 'target': 'github.com.'}
+                    ],
+                    'too_deep': [
+                        {'fqdn': 'a.unit.tests.', 'depth': 3},
+                        {'fqdn': 'b.unit.tests.', 'depth': 3},
+                        {'fqdn': 'c.unit.tests.', 'depth': 3},
+                        {'fqdn': 'into.unit.tests.', 'depth': 4},
+                        {'fqdn': 'x.unit.tests.', 'depth': 3},
+                    ],
+                },
+                report,
+            )
+            counts = target.stats.counts
+            self.assertEqual(2, counts['lint_loops'])
+            self.assertEqual(1, counts['lint_dangling'])
+            self.assertEqual(5, counts['lint_too_deep'])
+            # Everything was still written
+            self.assertTrue(isfile(path.join(directory, 'unit.tests.hosts')))
+
+            # Strict fails before anything is written
+            directory = path.join(td.dirname, 'strict')
+            target = EtcHostsProvider('test', directory, strict=True)
+            with self.assertRaisesRegex(
+                ProviderException,
+                'Lint failed with 2 loops, 1 dangling targets and 0 chains',
+            ):
+                target.apply(target.plan(zone))
+            self.assertEqual([], listdir(directory))
+
+            # And is happy when there's nothing wrong
+            clean = Zone('unit.tests.', [])
+            for record in zone.records:
+                if record.name in ('www', 'x', 'y', 'z'):
+                    clean.add_record(record)
+            target = EtcHostsProvider('test', directory, strict=True)
+            target.apply(target.plan(clean))
+            self.assertEqual(['unit.tests.hosts'], listdir(directory))
+
+    def test_max_chain_depth(self):
+        zone = Zone('unit.tests.', [])
+        for name, data in (
+            ('www', {'type': 'A', 'value': '1.1.1.1'}),
+            ('x', {'type': 'CNAME', 'value': 'y.unit.tests.'}),
+            ('y', {'type': 'CNAME', 'value': 'z.unit.tests.'}),
+            ('z', {'type': 'CNAME', 'value': 'www.unit.tests.'}),
+            ('a', {'type': 'CNAME', 'value': 'b.unit.tests.'}),
+            ('b', {'type': 'CNAME', 'value': 'a.unit.tests.'}),
+            ('into', {'type': 'CNAME', 'value': 'a.unit.tests.'}),
+        ):
+            zone.add_record(Record.new(zone, name, {'ttl': 60, **data}))
+
+        with TemporaryDirectory() as td:
+            directory = path.join(td.dirname, 'hosts')
+            target = EtcHostsProvider('test', directory, max_chain_depth=2)
+            target.apply(target.plan(zone))
+            with open(path.join(directory, 'unit.tests.hosts')) as fh:
+                data = fh.read()
+            # Only the first max_chain_depth hops are followed
+            self.assertTrue(
+                '# x.unit.tests. -> y.unit.tests.\n'
+                '# y.unit.tests. -> z.unit.tests.\n'
+                '# ** chain too deep **\n\n' in data
+            )
+            self.assertTrue(
+                '# into.unit.tests. -> a.unit.tests.\n'
+                '# a.unit.tests. -> b.unit.tests.\n'
+                '# ** chain too deep **\n\n' in data
+            )
+            # Those that fit are untouched
+            self.assertTrue('1.1.1.1\ty.unit.tests\n' in data)
+            self.assertTrue(
+                '# b.unit.tests. -> a.unit.tests.\n'
+                '# ** loop detected **\n' in data
+            )
+            counts = target.stats.counts
+            self.assertEqual(2, counts['too_deep'])
+            self.assertEqual(2, counts['loops'])
+
+            # Everything is read back, including what was too deep, and
+            # writes out the same
+            copy = Zone('unit.tests.', [])
+            target.populate(copy)
+
+            def contents(zone):
+                return {
+                    (
+                        r.name,
+                        r._type,
+                        str(r.data.get('value', r.data.get('values'))),
+                    )
+                    for r in zone.records
+                }
+
+            self.assertEqual(contents(zone), contents(copy))
+            rewrite_directory = path.join(td.dirname, 'rewrite')
+            rewrite = EtcHostsProvider(
+                'test', rewrite_directory, max_chain_depth=2
+            )
+            rewrite.apply(rewrite.plan(copy))
+            with open(path.join(rewrite_directory, 'unit.tests.hosts')) as fh:
+                self.assertEqual(data, fh.read())
+
+            # They're left out of the combined file
+            target = EtcHostsProvider(
+                'test', directory, combined_file='hosts', max_chain_depth=2
+            )
+            target.apply(target.plan(zone))
+            with open(path.join(directory, 'hosts')) as fh:
+                data = fh.read()
+            self.assertFalse('\tx.unit.tests\n' in data)
+            self.assertTrue('1.1.1.1\ty.unit.tests\n' in data)
+            self.assertEqual(2, target.stats.counts['too_deep'])
+
+        with self.assertRaisesRegex(
+            ProviderException, 'Unsupported max_chain_depth -1, must be 0 or'
+        ):
+            EtcHostsProvider('test', 'not-used', max_chain_depth=-1)
+
+    def test_processes(self):
+        big = Zone('big.tests.', [])
+        for i in range(12):
+            big.add_record(
+                Record.new(
+                    big, f'www{i}', {'ttl': 60, 'type': 'A', 'value': '1.1.1.1'}
+                )
+            )
+        for name, data in (
+            ('*.w', {'type': 'A', 'value': '2.2.2.2'}),
+            ('a', {'type': 'CNAME', 'value': 'b.big.tests.'}),
+            ('b', {'type': 'CNAME', 'value': 'a.big.tests.'}),
+            ('x', {'type': 'CNAME', 'value': 'www.small.tests.'}),
+            ('y', {'type': 'CNAME', 'value': 'q.w.big.tests.'}),
+        ):
+            big.add_record(Record.new(big, name, {'ttl': 60, **data}))
+        small = Zone('small.tests.', [])
+        small.add_record(
+            Record.new(
+                small, 'www', {'ttl': 60, 'type': 'A', 'value': '3.3.3.3'}
+            )
+        )
+
+        def apply(directory, **kwargs):
+            target = EtcHostsProvider(
+                'test',
+                directory,
+                binary_index=True,
+                verbosity='minimal',
+                diagnostics=True,
+                shard_size=5,
+                **kwargs,
+            )
+            plans = [target.plan(zone) for zone in (big, small)]
+            for plan in plans:
+                target.apply(plan)
+            data = {}
+            for filename in listdir(directory):
+                with open(path.join(directory, filename), 'rb') as fh:
+                    data[filename] = fh.read()
+            return target, data
+
+        with TemporaryDirectory() as td:
+            expected_target, expected = apply(path.join(td.dirname, 'one'))
+            self.assertEqual(6, len(expected))
+
+            # Only big is sharded, the results are the same either way
+            target, data = apply(
+                path.join(td.dirname, 'two'), processes=2, workers=2
+            )
+            self.assertEqual(expected, data)
+            counts = target.stats.counts
+            for key in ('values', 'loops', 'wildcards'):
+                self.assertEqual(expected_target.stats.counts[key], counts[key])
+            self.assertIsNone(target._pool)
+            self.assertIsNone(octodns_etchosts._shared)
+
+            # Forking with other threads around isn't safe, everything is
+            # rendered here instead
+            done = Event()
+            other = Thread(target=done.wait)
+            other.start()
+            try:
+                with self.assertLogs('EtcHostsProvider[test]', 'WARNING'):
+                    _, data = apply(
+                        path.join(td.dirname, 'threads'), processes=2
+                    )
+            finally:
+                done.set()
+                other.join()
+            self.assertEqual(expected, data)
+
+            # The same rendering, in this process, so that it's measured
+            target = EtcHostsProvider(
+                'test', 'not-used', verbosity='minimal', shard_size=5
+            )
+            for zone in (big, small):
+                target._zones.append(target._index(zone))
+            target._sort()
+            resolver = _Resolver(target._records, target._wildcards)
+            target._pool = SimpleNamespace(imap=map)
+            octodns_etchosts._shared = (target, resolver, dict(target._zones))
+            try:
+                counts = defaultdict(int)
+                name, records = target._zones[0]
+                text = ''.join(
+                    target._render(name, records, resolver, None, counts)
+                )
+            finally:
+                octodns_etchosts._shared = None
+            self.assertEqual(expected['big.tests.hosts'].decode('utf-8'), text)
+            self.assertEqual(
+                expected_target.stats.counts['loops'], counts['loops']
+            )
+
+        # Sharding waits for all of the zones rather than forking a pool for
+        # each of them
+        target = EtcHostsProvider(
+            'test', 'not-used', processes=2, write_early=True
+        )
+        self.assertFalse(target._writing_early)
+
+        # Platforms without fork are caught up front
+        with patch(
+            'multiprocessing.get_all_start_methods', return_value=['spawn']
+        ):
+            with self.assertRaisesRegex(
+                ProviderException, 'processes requires the fork start method'
+            ):
+                EtcHostsProvider('test', 'not-used', processes=2)
+
+        with self.assertRaisesRegex(
+            ProviderException, 'Unsupported processes 0, must be 1 or more'
+        ):
+            EtcHostsProvider('test', 'not-used', processes=0)
+        with self.assertRaisesRegex(
+            ProviderException, 'Unsupported shard_size 0, must be 1 or more'
+        ):
+            EtcHostsProvider('test', 'not-used', shard_size=0)
+
+    def test_import_time(self):
+        def imported(code):
+            # -X importtime lists every module imported, along with how long
+            # it took, on stderr
+            result = run(
+                [executable, '-X', 'importtime', '-c', code],
+                capture_output=True,
+                check=True,
+                # pytest's pythonpath doesn't carry over to the child
+                cwd=ROOT,
+                text=True,
+            )
+            modules = {}
+            # Skip the header, then `import time: <self> | <cumulative> |
+            # <module>`, in microseconds
+            for line in result.stderr.splitlines()[1:]:
+                _, cumulative, module = line.split('|')
+                modules[module.strip()] = int(cumulative)
+            return modules
+
+        octodns = imported('import octodns.provider.base, octodns.record')
+        ours = imported('import octodns_etchosts')
+        # Only pay for what's used, none of these are needed until optional
+        # features are enabled
+        self.assertEqual(
+            set(),
+            {
+                'concurrent.futures',
+                'cProfile',
+                'gzip',
+                'mmap',
+                'multiprocessing',
+                'queue',
+            }
+            & (ours.keys() - octodns.keys()),
+        )
+        self.assertTrue('octodns_etchosts' in ours)
+
+    def test_benchmark(self):
+        # A tiny run to make sure the benchmark keeps up with the internals it
+        # drives
+        result = run(
+            [
+                executable,
+                path.join(ROOT, 'script', 'benchmark'),
+                '--zones',
+                '1',
+                '--a',
+                '5',
+                '--aaaa',
+                '2',
+                '--chains',
+                '3',
+                '--wildcards',
+                '2',
+                '--loops',
+                '1',
+                '--json',
+            ],
+            capture_output=True,
+            check=True,
+            cwd=ROOT,
+            text=True,
+        )
+        results = loads(result.stdout)
+        self.assertEqual(24, results['records'])
+        self.assertEqual(
+            {'index', 'resolve', 'write', 'total'}, set(results['phases'])
+        )